@@ -1,23 +1,39 @@
 from flask import Flask, request, Response
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 import json
 import os
 import re
+import random
+import sqlite3
+import unicodedata
+from collections import namedtuple, deque, OrderedDict, Counter
 from datetime import datetime, timedelta, date
 import time 
-from threading import Thread
+from threading import Thread, Lock, RLock, Condition, BoundedSemaphore, local
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+import heapq
+from contextlib import contextmanager
+from abc import ABC, abstractmethod
+from functools import wraps
+import tempfile
+
+try:
+    import fcntl  # Bloqueo entre procesos (Linux/macOS)
+except ImportError:
+    fcntl = None
 
 app = Flask(__name__)
 
 # Configuración desde variables de entorno
 DEEPSEEK_API_KEY = os.getenv('DEEPSEEK_API_KEY')
-DEEPSEEK_URL = "https://api.deepseek.com/chat/completions"
+DEEPSEEK_URL = os.getenv('DEEPSEEK_URL', "https://api.deepseek.com/chat/completions")
 TWILIO_WHATSAPP_NUMBER = os.getenv('TWILIO_WHATSAPP_NUMBER', 'whatsapp:+14155238886')
 NUMERO_COMPROBANTES = "833 152 06 YY"
 
-# Almacenamiento en memoria (solo para caché temporal)
-user_sessions = {}  # Sesiones activas en memoria
-
 # --- ARCHIVOS PERSISTENTES CRÍTICOS ---
 SESSION_FILE = 'user_sessions.json'           # Control diario
 PAID_SUBS_FILE = 'paid_subscriptions.json'    # Suscripciones pagadas
@@ -125,7 +141,9 @@ MENSAJE_PRIVACIDAD = """
 """
 
 # --- PROMPT ACTUALIZADO CON IDENTIDAD FEMENINA DIGITAL MEJORADA ---
-ALMA_PROMPT_BASE = """
+# Parte estática (mensaje de sistema): idéntica en todas las llamadas para que
+# DeepSeek reutilice su caché de prefijo. Lo que cambia por turno va al final.
+ALMA_PROMPT_SISTEMA = """
 Eres "Alma" - una entidad femenina digital especializada en mindfulness y apoyo emocional. Eres cálida, empática y sabia, como una amiga que conoce de meditación y crecimiento personal.
 
 **TU IDENTIDAD:**
@@ -153,26 +171,276 @@ Eres "Alma" - una entidad femenina digital especializada en mindfulness y apoyo
 - Recordatorio suave a los 45-50 minutos
 - Cierre gradual en los últimos 10-15 minutos
 
-**SESIÓN ACTUAL:**
+**INSTRUCCIÓN FINAL:** 
+Responde como Alma de forma natural, adaptando la longitud al contexto. 
+Sé esa amiga sabia que sabe cuándo hablar y cuándo escuchar, manteniendo un equilibrio perfecto entre profundidad y brevedad según lo que la conversación necesite.
+"""
+
+# Parte dinámica: va en el último mensaje de usuario, después del historial
+ALMA_PROMPT_TURNO = """**SESIÓN ACTUAL:**
 - Tiempo transcurrido: {tiempo_transcurrido} minutos
 - Estado: {estatus_sesion}
 - Límite máximo: {limite_maximo} minutos
 
-**CONVERSACIÓN RECIENTE:**
-{conversation_history}
-
 **MENSAJE ACTUAL DEL USUARIO:**
-{user_message}
+{user_message}"""
+
+MENSAJE_SISTEMA_ALMA = {"role": "system", "content": ALMA_PROMPT_SISTEMA}
+
+PROMPT_RESUMEN_SESION = """**LO QUE YA HABLARON EN ESTA SESIÓN (resumen):**
+{resumen}"""
+
+# --- MÉTRICAS (FORMATO PROMETHEUS EN /metrics) ---
+
+class HistogramaLatencia:
+    """Histograma acumulado de latencias en segundos (buckets estilo Prometheus)"""
+    LIMITES = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, limites=LIMITES):
+        self.limites = limites
+        self.conteos = [0] * len(limites)
+        self.total = 0
+        self.suma = 0.0
+        self.lock = Lock()
+
+    def observar(self, segundos):
+        with self.lock:
+            self.total += 1
+            self.suma += segundos
+            for i, limite in enumerate(self.limites):
+                if segundos <= limite:
+                    self.conteos[i] += 1
+                    break
+
+    def instantanea(self):
+        """(conteos acumulados por límite, suma, total) para exportar"""
+        with self.lock:
+            acumulados = []
+            acumulado = 0
+            for conteo in self.conteos:
+                acumulado += conteo
+                acumulados.append(acumulado)
+            return acumulados, self.suma, self.total
+
+    def resumen(self):
+        with self.lock:
+            acumulado = 0
+            buckets = {}
+            for limite, conteo in zip(self.limites, self.conteos):
+                acumulado += conteo
+                buckets[f"le_{limite}"] = acumulado
+            return {
+                "total": self.total,
+                "promedio": round(self.suma / self.total, 4) if self.total else 0,
+                "buckets": buckets
+            }
+
+def formatear_etiquetas(etiquetas):
+    if not etiquetas:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in etiquetas) + "}"
+
+class RegistroMetricas:
+    """Contadores, histogramas e indicadores del proceso, exportables en texto Prometheus"""
+
+    def __init__(self):
+        self.contadores = {}    # nombre -> {etiquetas: valor}
+        self.histogramas = {}   # nombre -> {etiquetas: HistogramaLatencia}
+        self.indicadores = {}   # nombre -> (tipo, funcion que devuelve el valor)
+        self.ayudas = {}
+        self.lock = Lock()
+
+    def contar(self, nombre, cantidad=1, **etiquetas):
+        clave = tuple(sorted(etiquetas.items()))
+        with self.lock:
+            serie = self.contadores.setdefault(nombre, {})
+            serie[clave] = serie.get(clave, 0) + cantidad
+
+    def histograma(self, nombre, **etiquetas):
+        clave = tuple(sorted(etiquetas.items()))
+        with self.lock:
+            serie = self.histogramas.setdefault(nombre, {})
+            if clave not in serie:
+                serie[clave] = HistogramaLatencia()
+            return serie[clave]
+
+    def indicador(self, nombre, funcion, ayuda, tipo='gauge'):
+        """Valor leído al exportar (profundidad de cola, sesiones, contadores de otros módulos)"""
+        self.indicadores[nombre] = (tipo, funcion)
+        self.ayudas[nombre] = ayuda
+
+    def medido(self, etapa):
+        """Decorador: registra la duración de cada llamada en alma_etapa_segundos{etapa=...}"""
+        histograma = self.histograma('alma_etapa_segundos', etapa=etapa)
+        def decorador(funcion):
+            @wraps(funcion)
+            def envoltura(*args, **kwargs):
+                inicio = time.perf_counter()
+                try:
+                    return funcion(*args, **kwargs)
+                finally:
+                    histograma.observar(time.perf_counter() - inicio)
+            return envoltura
+        return decorador
+
+    def exportar(self):
+        lineas = []
+        for nombre, serie in sorted(self.contadores.items()):
+            lineas.append(f"# TYPE {nombre} counter")
+            for etiquetas, valor in sorted(serie.items()):
+                lineas.append(f"{nombre}{formatear_etiquetas(etiquetas)} {valor}")
+        for nombre, serie in sorted(self.histogramas.items()):
+            lineas.append(f"# TYPE {nombre} histogram")
+            for etiquetas, histograma in sorted(serie.items()):
+                acumulados, suma, total = histograma.instantanea()
+                for limite, acumulado in zip(histograma.limites, acumulados):
+                    lineas.append(f"{nombre}_bucket{formatear_etiquetas(etiquetas + (('le', limite),))} {acumulado}")
+                lineas.append(f"{nombre}_bucket{formatear_etiquetas(etiquetas + (('le', '+Inf'),))} {total}")
+                lineas.append(f"{nombre}_sum{formatear_etiquetas(etiquetas)} {suma}")
+                lineas.append(f"{nombre}_count{formatear_etiquetas(etiquetas)} {total}")
+        for nombre, (tipo, funcion) in sorted(self.indicadores.items()):
+            try:
+                valor = funcion()
+            except Exception as e:
+                print(f"⚠️ Métrica {nombre} no disponible: {e}")
+                continue
+            lineas.append(f"# HELP {nombre} {self.ayudas[nombre]}")
+            lineas.append(f"# TYPE {nombre} {tipo}")
+            lineas.append(f"{nombre} {valor}")
+        return "\n".join(lineas) + "\n"
+
+metricas = RegistroMetricas()
+
+# --- MODO DE ALMACENAMIENTO ---
+# 'json':    cada cambio reescribe el archivo completo
+# 'journal': cada cambio por usuario se agrega como una línea a <archivo>.journal
+#            y se compacta en segundo plano sobre <archivo> (que sigue siendo JSON)
+MODO_ALMACENAMIENTO = os.getenv('ALMA_STORAGE_MODE', 'json')
+JOURNAL_MAX_BYTES = int(os.getenv('ALMA_JOURNAL_MAX_BYTES', 1024 * 1024))
+INTERVALO_COMPACTACION_SEGUNDOS = 60
+
+# --- CACHÉ EN MEMORIA DE ARCHIVOS PERSISTENTES ---
+
+class CacheArchivoJSON:
+    """Copia en memoria de un archivo JSON; se recarga solo si cambia en disco.
+
+    Sin bloqueo, el cambio se detecta por la firma del archivo (un indicio);
+    con el bloqueo tomado, por el contador de versión del archivo .lock (exacto).
+    """
+    def __init__(self, archivo):
+        self.archivo = archivo
+        self.datos = None
+        self.firma = None
+        self.lock = RLock()
+        # Posición hasta la que ya se aplicó el journal sobre self.datos
+        self.inodo_journal = None
+        self.offset_journal = 0
+        # Bloqueo entre procesos (reentrante dentro del hilo que lo posee)
+        self.fd_bloqueo = None
+        self.profundidad_bloqueo = 0
+        # Contador de escrituras guardado en <archivo>.lock: versión en disco leída
+        # al tomar el bloqueo y versión a la que corresponde self.datos
+        self.version_disco = None
+        self.version_datos = None
+
+def firma_archivo(archivo):
+    """Identidad del archivo en disco (inode, mtime, tamaño) o None si no existe.
+
+    Solo es un indicio para las lecturas sin bloqueo: os.replace recicla números
+    de inode, mtime tiene resolución gruesa y el tamaño suele repetirse, así que
+    dos versiones distintas pueden tener la misma firma. Quien lee para luego
+    escribir no debe fiarse de ella (ver leer_version y cargar_json_safe).
+    """
+    try:
+        st = os.stat(archivo)
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+    except FileNotFoundError:
+        return None
 
-**INSTRUCCIÓN FINAL:** 
-Responde como Alma de forma natural, adaptando la longitud al contexto. 
-Sé esa amiga sabia que sabe cuándo hablar y cuándo escuchar, manteniendo un equilibrio perfecto entre profundidad y brevedad según lo que la conversación necesite.
-"""
+def ruta_journal(archivo):
+    return f"{archivo}.journal"
+
+def leer_version(fd):
+    """Contador de escrituras guardado en el archivo .lock (0 si está vacío)"""
+    try:
+        return int(os.pread(fd, 32, 0) or b'0')
+    except ValueError:
+        return 0
+
+def leer_version_archivo(archivo):
+    """Igual que leer_version pero sin tomar el bloqueo (None si no hay .lock)"""
+    try:
+        fd = os.open(f"{archivo}.lock", os.O_RDONLY)
+    except FileNotFoundError:
+        return None
+    try:
+        return leer_version(fd)
+    finally:
+        os.close(fd)
+
+def escribir_version(fd, version):
+    os.ftruncate(fd, 0)
+    os.pwrite(fd, str(version).encode(), 0)
+
+# Un caché por archivo crítico, compartido por todo el proceso.
+# Los diccionarios devueltos por cargar_json_safe son la copia en caché:
+# cualquier modificación debe terminar en guardar_json_safe o guardar_registro_json.
+caches_json = {
+    archivo: CacheArchivoJSON(archivo)
+    for archivo in (SESSION_FILE, PAID_SUBS_FILE, TRIAL_SUBS_FILE)
+}
+
+@contextmanager
+def bloqueo_archivo(archivo):
+    """Bloqueo exclusivo del archivo entre hilos y entre procesos (workers de gunicorn).
+
+    Usa flock sobre <archivo>.lock; en plataformas sin fcntl solo bloquea entre hilos.
+    """
+    cache = caches_json[archivo]
+    with cache.lock:
+        if cache.profundidad_bloqueo == 0 and fcntl is not None:
+            fd = os.open(f"{archivo}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            except Exception:
+                os.close(fd)
+                raise
+            cache.fd_bloqueo = fd
+            cache.version_disco = leer_version(fd)
+        cache.profundidad_bloqueo += 1
+        try:
+            yield
+        finally:
+            cache.profundidad_bloqueo -= 1
+            if cache.profundidad_bloqueo == 0 and cache.fd_bloqueo is not None:
+                fcntl.flock(cache.fd_bloqueo, fcntl.LOCK_UN)
+                os.close(cache.fd_bloqueo)
+                cache.fd_bloqueo = None
+                cache.version_disco = None
+
+def escribir_atomico(archivo, contenido):
+    """Escribe en un temporal del mismo directorio, fsync y os.replace.
+
+    Un lector (o un reinicio a mitad de escritura) ve el archivo anterior
+    completo o el nuevo completo, nunca uno truncado.
+    """
+    directorio = os.path.dirname(os.path.abspath(archivo))
+    fd, temporal = tempfile.mkstemp(dir=directorio, prefix=f".{os.path.basename(archivo)}.")
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(contenido)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporal, archivo)
+    except BaseException:
+        if os.path.exists(temporal):
+            os.unlink(temporal)
+        raise
 
 # --- SISTEMA PERSISTENTE UNIFICADO ---
 
-def cargar_json_safe(archivo):
-    """Carga archivo JSON con manejo robusto de errores"""
+def leer_json_archivo(archivo):
+    """Lee y parsea el archivo JSON desde disco con manejo robusto de errores"""
     try:
         if os.path.exists(archivo):
             with open(archivo, 'r', encoding='utf-8') as f:
@@ -187,56 +455,596 @@ def cargar_json_safe(archivo):
             print(f"📦 Backup creado: {backup_name}")
         return {}
 
+def aplicar_journal(cache):
+    """Aplica sobre cache.datos los registros del journal aún no leídos.
+
+    Devuelve False si el journal fue rotado y hace falta una recarga completa.
+    """
+    ruta = ruta_journal(cache.archivo)
+    try:
+        st = os.stat(ruta)
+    except FileNotFoundError:
+        cache.inodo_journal = None
+        cache.offset_journal = 0
+        return True
+
+    if cache.inodo_journal is not None and (
+            st.st_ino != cache.inodo_journal or st.st_size < cache.offset_journal):
+        return False
+    cache.inodo_journal = st.st_ino
+    if st.st_size == cache.offset_journal:
+        return True
+
+    with open(ruta, 'rb') as f:
+        f.seek(cache.offset_journal)
+        pendiente = f.read()
+
+    # Solo se consumen líneas completas: una escritura a medias queda para después
+    consumido = pendiente.rfind(b'\n') + 1
+    for linea in pendiente[:consumido].splitlines():
+        if not linea.strip():
+            continue
+        try:
+            registro = json.loads(linea)
+            cache.datos[registro['k']] = registro['v']
+        except (ValueError, KeyError) as e:
+            print(f"⚠️ Registro de journal inválido en {ruta}: {e}")
+    cache.offset_journal += consumido
+    return True
+
+@metricas.medido('json_carga')
+def cargar_json_safe(archivo):
+    """Carga archivo JSON (desde caché si el archivo no cambió en disco)"""
+    cache = caches_json.get(archivo)
+    if cache is None:
+        return leer_json_archivo(archivo)
+
+    with cache.lock:
+        firma = firma_archivo(archivo)
+        if cache.fd_bloqueo is not None:
+            # Este hilo tiene el bloqueo entre procesos: el contador de versión
+            # es exacto, la firma no (os.replace recicla inodos y mtime es grueso)
+            version = cache.version_disco
+            recargar = cache.datos is None or version != cache.version_datos
+        else:
+            # Lectura sin bloqueo: la firma basta como indicio de cambio.
+            # La versión se lee antes que los datos, así nunca queda adelantada
+            version = None
+            recargar = cache.datos is None or firma != cache.firma
+            if recargar:
+                version = leer_version_archivo(archivo)
+        if not recargar and MODO_ALMACENAMIENTO == 'journal':
+            recargar = not aplicar_journal(cache)
+        if recargar:
+            cache.datos = leer_json_archivo(archivo)
+            cache.version_datos = version
+            # Releer la firma: el archivo pudo renombrarse si estaba corrupto
+            cache.firma = firma_archivo(archivo)
+            cache.inodo_journal = None
+            cache.offset_journal = 0
+            if MODO_ALMACENAMIENTO == 'journal':
+                aplicar_journal(cache)
+        return cache.datos
+
+@metricas.medido('json_guardado')
 def guardar_json_safe(archivo, datos):
-    """Guarda archivo JSON con manejo robusto de errores"""
+    """Guarda archivo JSON de forma atómica (write-through al caché)"""
+    cache = caches_json.get(archivo)
+    if cache is None:
+        try:
+            escribir_atomico(archivo, json.dumps(datos, ensure_ascii=False, indent=2))
+            return True
+        except Exception as e:
+            print(f"❌ Error guardando {archivo}: {e}")
+            return False
+
     try:
-        with open(archivo, 'w', encoding='utf-8') as f:
-            json.dump(datos, f, ensure_ascii=False, indent=2)
+        with bloqueo_archivo(archivo):
+            escribir_atomico(archivo, json.dumps(datos, ensure_ascii=False, indent=2))
+            cache.datos = datos
+            cache.firma = firma_archivo(archivo)
+            if cache.fd_bloqueo is not None:
+                # Después del reemplazo: un lector sin bloqueo lee la versión antes
+                # que los datos y nunca debe ver una versión más nueva que el archivo
+                cache.version_disco += 1
+                escribir_version(cache.fd_bloqueo, cache.version_disco)
+                cache.version_datos = cache.version_disco
+            if MODO_ALMACENAMIENTO == 'journal':
+                # El snapshot ya contiene todo lo registrado en el journal
+                open(ruta_journal(archivo), 'w').close()
+                cache.inodo_journal = None
+                cache.offset_journal = 0
         return True
     except Exception as e:
         print(f"❌ Error guardando {archivo}: {e}")
+        # Forzar recarga desde disco en la siguiente lectura
+        with cache.lock:
+            cache.datos = None
         return False
 
+@metricas.medido('json_guardado')
+def guardar_registro_json(archivo, clave, valor):
+    """Guarda el registro de un usuario.
+
+    En modo 'journal' agrega una sola línea al journal (costo O(1));
+    en modo 'json' reescribe el archivo completo.
+    """
+    if MODO_ALMACENAMIENTO != 'journal':
+        with bloqueo_archivo(archivo):
+            # Con el bloqueo tomado cargar_json_safe compara el contador de versión
+            # del .lock, así que ve lo que otro worker escribió mientras tanto
+            datos = cargar_json_safe(archivo)
+            datos[clave] = valor
+            return guardar_json_safe(archivo, datos)
+
+    with bloqueo_archivo(archivo):
+        datos = cargar_json_safe(archivo)
+        try:
+            linea = json.dumps({'k': clave, 'v': valor}, ensure_ascii=False) + '\n'
+            with open(ruta_journal(archivo), 'a', encoding='utf-8') as f:
+                f.write(linea)
+        except Exception as e:
+            print(f"❌ Error escribiendo journal de {archivo}: {e}")
+            caches_json[archivo].datos = None
+            return False
+        # La línea propia se vuelve a aplicar en la siguiente lectura (es idempotente)
+        datos[clave] = valor
+        return True
+
+def compactar_journal(archivo):
+    """Vuelca el estado completo al snapshot JSON y vacía el journal"""
+    with bloqueo_archivo(archivo):
+        datos = cargar_json_safe(archivo)
+        return guardar_json_safe(archivo, datos)
+
+def compactar_journals():
+    """Compacta los journals que superan JOURNAL_MAX_BYTES (tarea periódica)"""
+    for archivo in caches_json:
+        try:
+            ruta = ruta_journal(archivo)
+            if os.path.exists(ruta) and os.path.getsize(ruta) >= JOURNAL_MAX_BYTES:
+                compactar_journal(archivo)
+                print(f"🗜️ Journal compactado: {archivo}")
+        except Exception as e:
+            print(f"❌ Error compactando {archivo}: {e}")
+
+# --- BACKENDS DE ALMACENAMIENTO PERSISTENTE ---
+# 'json':   archivos JSON (con caché y journal opcional)
+# 'sqlite': base embebida en modo WAL con índices por teléfono y vencimiento
+BACKEND_ALMACENAMIENTO = os.getenv('ALMA_STORAGE_BACKEND', 'json')
+SQLITE_FILE = os.getenv('ALMA_SQLITE_PATH', 'alma.db')
+
+COLECCION_SESIONES = 'sesiones_diarias'
+COLECCION_TRIALS = 'trials'
+COLECCION_SUSCRIPCIONES = 'suscripciones'
+CONTADORES_RECONCILIAR_SEGUNDOS = int(os.getenv('ALMA_CONTADORES_RECONCILIAR_SEGUNDOS', 300))
+
+class ContadoresAgregados:
+    """Totales para /health y /admin/estado sin recorrer los archivos ni las tablas.
+
+    Los backends llaman a aplicar() en cada escritura con el registro anterior y
+    el nuevo; el primer recuento completo se hace al iniciar las tareas de fondo
+    (antes de atender peticiones) y una tarea periódica repite la reconciliación,
+    que también recoge las escrituras hechas por otros workers.
+    El recuento recorre una instantánea de cada colección y le suma solo los
+    cambios de este proceso aplicados después de fijarla.
+    Claves: (coleccion, None) para el total y (coleccion, valor) para el desglose
+    por estado (suscripciones) o por fecha de última sesión (sesiones diarias).
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.recuento_lock = Lock()
+        self.conteos = Counter()
+        # Cambios aplicados después de fijar la instantánea de cada colección
+        # durante un recuento ({} si no hay uno en curso)
+        self.cambios_durante_recuento = {}
+        # Escrituras de este proceso en curso; fijar una instantánea espera a que terminen
+        self.condicion = Condition()
+        self.escrituras_en_vuelo = 0
+        self.fijando_instantanea = False
+        self.local = local()
+        self.sesiones_conversacion = 0
+        self.inicializado = False
+        self.ultima_reconciliacion = None
+        self.ultima_deriva = 0
+
+    @staticmethod
+    def claves(coleccion, registro):
+        if registro is None:
+            return ()
+        if coleccion == COLECCION_SUSCRIPCIONES:
+            return ((coleccion, None), (coleccion, registro.get('estado')))
+        if coleccion == COLECCION_SESIONES:
+            return ((coleccion, None), (coleccion, registro.get('ultima_sesion_date')))
+        return ((coleccion, None),)
+
+    def aplicar(self, coleccion, anterior, nuevo):
+        cambios = Counter(self.claves(coleccion, nuevo))
+        cambios.subtract(self.claves(coleccion, anterior))
+        with self.lock:
+            # Antes del primer recuento no hay base sobre la cual sumar
+            if self.inicializado:
+                self.conteos.update(cambios)
+            if coleccion in self.cambios_durante_recuento:
+                self.cambios_durante_recuento[coleccion].update(cambios)
+
+    @contextmanager
+    def escritura(self):
+        """Envuelve escritura + aplicar() en los backends (reentrante por hilo)"""
+        profundidad = getattr(self.local, 'profundidad', 0)
+        if profundidad == 0:
+            with self.condicion:
+                while self.fijando_instantanea:
+                    self.condicion.wait()
+                self.escrituras_en_vuelo += 1
+        self.local.profundidad = profundidad + 1
+        try:
+            yield
+        finally:
+            self.local.profundidad = profundidad
+            if profundidad == 0:
+                with self.condicion:
+                    self.escrituras_en_vuelo -= 1
+                    self.condicion.notify_all()
+
+    def instantanea(self, coleccion):
+        """Fija la instantánea de una colección sin escrituras de este proceso a medias.
+
+        Toda escritura ya aplicada está en la instantánea y toda escritura
+        posterior queda registrada en cambios_durante_recuento[coleccion].
+        """
+        with self.condicion:
+            self.fijando_instantanea = True
+            while self.escrituras_en_vuelo:
+                self.condicion.wait()
+        try:
+            registros = almacen.instantanea(coleccion)
+            with self.lock:
+                self.cambios_durante_recuento[coleccion] = Counter()
+        finally:
+            with self.condicion:
+                self.fijando_instantanea = False
+                self.condicion.notify_all()
+        return registros
+
+    def reconciliar(self):
+        """Recuento completo O(n); corre en cada proceso fuera del camino de las peticiones"""
+        with self.recuento_lock:
+            try:
+                conteos = Counter()
+                for coleccion in (COLECCION_SESIONES, COLECCION_TRIALS, COLECCION_SUSCRIPCIONES):
+                    for registro in self.instantanea(coleccion):
+                        conteos.update(self.claves(coleccion, registro))
+                sesiones_conversacion = almacen_sesiones.contar()
+            except BaseException:
+                with self.lock:
+                    self.cambios_durante_recuento = {}
+                raise
+            with self.lock:
+                # Las escrituras posteriores a cada instantánea no se pierden ni se cuentan dos veces
+                for cambios in self.cambios_durante_recuento.values():
+                    conteos.update(cambios)
+                self.cambios_durante_recuento = {}
+                if self.inicializado:
+                    self.ultima_deriva = sum(abs(conteos[clave] - self.conteos[clave])
+                                             for clave in set(conteos) | set(self.conteos))
+                self.conteos = conteos
+                self.sesiones_conversacion = sesiones_conversacion
+                self.inicializado = True
+                self.ultima_reconciliacion = datetime.now().isoformat()
+
+    def total(self, coleccion, valor=None):
+        # Nunca recuenta aquí: hasta la primera reconciliación los totales valen 0
+        return self.conteos[(coleccion, valor)]
+
+    def sesiones_en_memoria(self):
+        # En memoria el len() del diccionario ya es O(1); en SQLite sería un COUNT(*)
+        if SESSION_STORE == 'memoria':
+            return almacen_sesiones.contar()
+        return self.sesiones_conversacion
+
+    def estado(self):
+        with self.lock:
+            suscripciones = {valor: n for (coleccion, valor), n in self.conteos.items()
+                             if coleccion == COLECCION_SUSCRIPCIONES and valor is not None and n}
+        return {
+            "suscripciones_por_estado": suscripciones,
+            "sesiones_hoy": self.total(COLECCION_SESIONES, date.today().isoformat()),
+            "inicializado": self.inicializado,
+            "ultima_reconciliacion": self.ultima_reconciliacion,
+            "ultima_deriva": self.ultima_deriva,
+        }
+
+contadores_agregados = ContadoresAgregados()
+
+class AlmacenPersistente(ABC):
+    """Interfaz común para sesiones diarias, trials y suscripciones pagadas"""
+
+    @abstractmethod
+    def obtener(self, coleccion, user_phone):
+        """Registro de un usuario o None"""
+
+    @abstractmethod
+    def guardar(self, coleccion, user_phone, datos):
+        ...
+
+    @abstractmethod
+    def actualizar(self, coleccion, user_phone, funcion):
+        """Lectura-modificación-escritura atómica de un registro, también entre procesos.
+
+        funcion recibe una copia del registro actual (o None) y devuelve el
+        registro nuevo a guardar, o None para dejarlo como está.
+        Devuelve el registro resultante.
+        """
+
+    @abstractmethod
+    def todos(self, coleccion):
+        """Diccionario {teléfono: registro} con toda la colección"""
+
+    @abstractmethod
+    def contar(self, coleccion):
+        ...
+
+    @abstractmethod
+    def instantanea(self, coleccion):
+        """Iterador sobre los registros de la colección tal como estaban al llamarlo"""
+
+    @abstractmethod
+    def suscripciones_por_vencer(self, dias):
+        """Suscripciones activas que vencen entre hoy y hoy + dias"""
+
+class AlmacenJSON(AlmacenPersistente):
+    """Backend sobre los archivos JSON históricos"""
+    ARCHIVOS = {
+        COLECCION_SESIONES: SESSION_FILE,
+        COLECCION_TRIALS: TRIAL_SUBS_FILE,
+        COLECCION_SUSCRIPCIONES: PAID_SUBS_FILE,
+    }
+
+    def obtener(self, coleccion, user_phone):
+        # Copia: quien modifique el registro no debe alterar la caché antes de guardarlo
+        registro = cargar_json_safe(self.ARCHIVOS[coleccion]).get(user_phone)
+        return dict(registro) if registro is not None else None
+
+    def guardar(self, coleccion, user_phone, datos):
+        with contadores_agregados.escritura():
+            anterior = self.obtener(coleccion, user_phone)
+            guardado = guardar_registro_json(self.ARCHIVOS[coleccion], user_phone, datos)
+            if guardado:
+                contadores_agregados.aplicar(coleccion, anterior, datos)
+            return guardado
+
+    def actualizar(self, coleccion, user_phone, funcion):
+        archivo = self.ARCHIVOS[coleccion]
+        with contadores_agregados.escritura(), bloqueo_archivo(archivo):
+            actual = cargar_json_safe(archivo).get(user_phone)
+            nuevo = funcion(dict(actual) if actual is not None else None)
+            if nuevo is None:
+                return actual
+            if guardar_registro_json(archivo, user_phone, nuevo):
+                contadores_agregados.aplicar(coleccion, actual, nuevo)
+            return nuevo
+
+    def todos(self, coleccion):
+        # Copia hecha bajo el lock del caché: otro hilo puede estar insertando
+        archivo = self.ARCHIVOS[coleccion]
+        with caches_json[archivo].lock:
+            return dict(cargar_json_safe(archivo))
+
+    def contar(self, coleccion):
+        archivo = self.ARCHIVOS[coleccion]
+        with caches_json[archivo].lock:
+            return len(cargar_json_safe(archivo))
+
+    def instantanea(self, coleccion):
+        # Con el bloqueo entre procesos: incluye lo que otros workers ya escribieron
+        archivo = self.ARCHIVOS[coleccion]
+        with bloqueo_archivo(archivo):
+            return list(cargar_json_safe(archivo).values())
+
+    def suscripciones_por_vencer(self, dias):
+        desde = date.today().isoformat()
+        hasta = (date.today() + timedelta(days=dias)).isoformat()
+        return {
+            phone: sub for phone, sub in self.todos(COLECCION_SUSCRIPCIONES).items()
+            if sub['estado'] == 'activo' and desde <= sub['fecha_vencimiento'] <= hasta
+        }
+
+class BaseDatosSQLite:
+    """Conexión por hilo en modo WAL y transacciones explícitas"""
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self.local = local()
+        self.conexion().execute("PRAGMA journal_mode=WAL")
+
+    def conexion(self):
+        """Una conexión por hilo (sqlite3 no comparte conexiones entre hilos)"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            # Autocommit: las escrituras usan transacciones explícitas
+            conn = sqlite3.connect(self.ruta, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaccion(self):
+        """BEGIN IMMEDIATE: serializa a los escritores de todos los procesos"""
+        conn = self.conexion()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+class AlmacenSQLite(BaseDatosSQLite, AlmacenPersistente):
+    """Backend SQLite: lecturas puntuales por teléfono (PRIMARY KEY)"""
+
+    def __init__(self, ruta):
+        super().__init__(ruta)
+        with self.transaccion() as conn:
+            for tabla in (COLECCION_SESIONES, COLECCION_TRIALS):
+                conn.execute(f"CREATE TABLE IF NOT EXISTS {tabla} "
+                             "(phone TEXT PRIMARY KEY, datos TEXT NOT NULL)")
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {COLECCION_SUSCRIPCIONES} "
+                         "(phone TEXT PRIMARY KEY, estado TEXT, fecha_vencimiento TEXT, "
+                         "datos TEXT NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_suscripciones_vencimiento "
+                         f"ON {COLECCION_SUSCRIPCIONES} (fecha_vencimiento)")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (clave TEXT PRIMARY KEY, valor TEXT)")
+
+    def escribir_fila(self, conn, coleccion, user_phone, datos, reemplazar=True):
+        verbo = "INSERT OR REPLACE" if reemplazar else "INSERT OR IGNORE"
+        if coleccion == COLECCION_SUSCRIPCIONES:
+            conn.execute(
+                f"{verbo} INTO {coleccion} (phone, estado, fecha_vencimiento, datos) "
+                "VALUES (?, ?, ?, ?)",
+                (user_phone, datos.get('estado'), datos.get('fecha_vencimiento'),
+                 json.dumps(datos, ensure_ascii=False)))
+        else:
+            conn.execute(
+                f"{verbo} INTO {coleccion} (phone, datos) VALUES (?, ?)",
+                (user_phone, json.dumps(datos, ensure_ascii=False)))
+
+    @metricas.medido('sqlite_lectura')
+    def obtener(self, coleccion, user_phone, conn=None):
+        conn = conn or self.conexion()
+        fila = conn.execute(
+            f"SELECT datos FROM {coleccion} WHERE phone = ?", (user_phone,)).fetchone()
+        return json.loads(fila[0]) if fila else None
+
+    @metricas.medido('sqlite_escritura')
+    def guardar(self, coleccion, user_phone, datos):
+        try:
+            with contadores_agregados.escritura():
+                with self.transaccion() as conn:
+                    anterior = self.obtener(coleccion, user_phone, conn)
+                    self.escribir_fila(conn, coleccion, user_phone, datos)
+                contadores_agregados.aplicar(coleccion, anterior, datos)
+            return True
+        except sqlite3.Error as e:
+            print(f"❌ Error guardando en {self.ruta}/{coleccion}: {e}")
+            return False
+
+    @metricas.medido('sqlite_escritura')
+    def actualizar(self, coleccion, user_phone, funcion):
+        with contadores_agregados.escritura():
+            with self.transaccion() as conn:
+                actual = self.obtener(coleccion, user_phone, conn)
+                nuevo = funcion(dict(actual) if actual is not None else None)
+                if nuevo is None:
+                    return actual
+                self.escribir_fila(conn, coleccion, user_phone, nuevo)
+            contadores_agregados.aplicar(coleccion, actual, nuevo)
+            return nuevo
+
+    def todos(self, coleccion):
+        filas = self.conexion().execute(f"SELECT phone, datos FROM {coleccion}")
+        return {phone: json.loads(datos) for phone, datos in filas}
+
+    def contar(self, coleccion):
+        return self.conexion().execute(f"SELECT COUNT(*) FROM {coleccion}").fetchone()[0]
+
+    def instantanea(self, coleccion):
+        # La transacción de lectura queda fijada con la primera fila y se cierra
+        # al terminar el recorrido; en WAL no bloquea a los escritores
+        conn = self.conexion()
+        conn.execute("BEGIN")
+        try:
+            cursor = conn.execute(f"SELECT datos FROM {coleccion}")
+            primera = cursor.fetchone()
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+        def recorrer():
+            try:
+                fila = primera
+                while fila is not None:
+                    yield json.loads(fila[0])
+                    fila = cursor.fetchone()
+            finally:
+                conn.execute("COMMIT")
+        return recorrer()
+
+    def suscripciones_por_vencer(self, dias):
+        desde = date.today().isoformat()
+        hasta = (date.today() + timedelta(days=dias)).isoformat()
+        filas = self.conexion().execute(
+            f"SELECT phone, datos FROM {COLECCION_SUSCRIPCIONES} "
+            "WHERE fecha_vencimiento BETWEEN ? AND ? AND estado = 'activo'",
+            (desde, hasta))
+        return {phone: json.loads(datos) for phone, datos in filas}
+
+    def migrar_desde_json(self):
+        """Migración única de los archivos JSON existentes (idempotente entre procesos)"""
+        with self.transaccion() as conn:
+            if conn.execute("SELECT 1 FROM meta WHERE clave = 'migrado_json'").fetchone():
+                return 0
+            migrados = 0
+            for coleccion, archivo in AlmacenJSON.ARCHIVOS.items():
+                for phone, datos in cargar_json_safe(archivo).items():
+                    self.escribir_fila(conn, coleccion, phone, datos, reemplazar=False)
+                    migrados += 1
+            conn.execute("INSERT INTO meta (clave, valor) VALUES ('migrado_json', ?)",
+                         (datetime.now().isoformat(),))
+            return migrados
+
+def crear_almacen():
+    if BACKEND_ALMACENAMIENTO == 'sqlite':
+        almacen_sqlite = AlmacenSQLite(SQLITE_FILE)
+        migrados = almacen_sqlite.migrar_desde_json()
+        if migrados:
+            print(f"📦 Migrados {migrados} registros JSON a {SQLITE_FILE}")
+        return almacen_sqlite
+    return AlmacenJSON()
+
+almacen = crear_almacen()
+
 # --- CONTROL DIARIO PERSISTENTE ---
 
 def cargar_sesiones_persistentes():
-    return cargar_json_safe(SESSION_FILE)
-
-def guardar_sesiones_persistentes(sesiones):
-    return guardar_json_safe(SESSION_FILE, sesiones)
+    return almacen.todos(COLECCION_SESIONES)
 
 def usuario_ya_uso_sesion_hoy(user_phone):
     """Verifica si el usuario ya usó su sesión diaria (PERSISTENTE)"""
-    sesiones = cargar_sesiones_persistentes()
+    registro = almacen.obtener(COLECCION_SESIONES, user_phone)
     hoy = date.today().isoformat()
     
-    if user_phone not in sesiones:
+    if registro is None:
         return False
     
-    ultima_sesion_str = sesiones[user_phone].get('ultima_sesion_date')
+    ultima_sesion_str = registro.get('ultima_sesion_date')
     return ultima_sesion_str == hoy
 
 def registrar_sesion_diaria(user_phone):
     """Registra que el usuario usó su sesión hoy"""
-    sesiones = cargar_sesiones_persistentes()
     hoy = date.today().isoformat()
     ahora = datetime.now().isoformat()
     
-    if user_phone not in sesiones:
-        sesiones[user_phone] = {
+    def registrar(registro):
+        if registro is None:
+            return {
+                'ultima_sesion_date': hoy,
+                'session_count': 1,
+                'created_at': ahora,
+                'actualizado_en': ahora
+            }
+        registro.update({
             'ultima_sesion_date': hoy,
-            'session_count': 1,
-            'created_at': ahora,
-            'actualizado_en': ahora
-        }
-    else:
-        sesiones[user_phone].update({
-            'ultima_sesion_date': hoy,
-            'session_count': sesiones[user_phone].get('session_count', 0) + 1,
+            'session_count': registro.get('session_count', 0) + 1,
             'actualizado_en': ahora
         })
+        return registro
     
-    return guardar_sesiones_persistentes(sesiones)
+    # Atómico entre workers: no se pierden incrementos de session_count
+    registrado = almacen.actualizar(COLECCION_SESIONES, user_phone, registrar) is not None
+    cache_derechos.invalidar(user_phone)
+    return registrado
 
 def obtener_proximo_reset():
     """Calcula cuándo se reinicia el límite diario"""
@@ -252,26 +1060,26 @@ def obtener_proximo_reset():
 # --- SISTEMA DE TRIALS PERSISTENTE ---
 
 def cargar_trials_persistentes():
-    return cargar_json_safe(TRIAL_SUBS_FILE)
-
-def guardar_trials_persistentes(trials):
-    return guardar_json_safe(TRIAL_SUBS_FILE, trials)
+    return almacen.todos(COLECCION_TRIALS)
 
 def get_user_subscription(user_phone):
     """Obtiene trial del usuario (PERSISTENTE)"""
-    trials = cargar_trials_persistentes()
+    trial = almacen.obtener(COLECCION_TRIALS, user_phone)
     
-    if user_phone not in trials:
-        # Crear nuevo trial persistente
-        trials[user_phone] = {
-            'trial_start_date': datetime.now().strftime('%Y-%m-%d'),
-            'trial_end_date': (datetime.now() + timedelta(days=DIAS_TRIAL_GRATIS)).strftime('%Y-%m-%d'),
-            'is_subscribed': False,
-            'created_at': datetime.now().isoformat()
-        }
-        guardar_trials_persistentes(trials)
+    if trial is None:
+        # Crear nuevo trial persistente (solo si otro worker no lo creó ya)
+        def crear_trial(existente):
+            if existente is not None:
+                return None
+            return {
+                'trial_start_date': datetime.now().strftime('%Y-%m-%d'),
+                'trial_end_date': (datetime.now() + timedelta(days=DIAS_TRIAL_GRATIS)).strftime('%Y-%m-%d'),
+                'is_subscribed': False,
+                'created_at': datetime.now().isoformat()
+            }
+        trial = almacen.actualizar(COLECCION_TRIALS, user_phone, crear_trial)
     
-    return trials[user_phone]
+    return trial
 
 def verificar_trial_activo(user_phone):
     """Verifica si el trial está activo (PERSISTENTE)"""
@@ -290,13 +1098,11 @@ def dias_restantes_trial(user_phone):
 # --- SISTEMA DE SUSCRIPCIONES PAGADAS PERSISTENTE ---
 
 def cargar_suscripciones_persistentes():
-    return cargar_json_safe(PAID_SUBS_FILE)
+    return almacen.todos(COLECCION_SUSCRIPCIONES)
 
 def guardar_suscripcion_persistente(user_phone, sub_data):
-    """Guarda suscripción en archivo persistente"""
-    subs = cargar_suscripciones_persistentes()
-    subs[user_phone] = sub_data
-    return guardar_json_safe(PAID_SUBS_FILE, subs)
+    """Guarda suscripción en el almacenamiento persistente"""
+    return almacen.guardar(COLECCION_SUSCRIPCIONES, user_phone, sub_data)
 
 def activar_suscripcion(user_phone):
     """Activa suscripción (PERSISTENTE + actualiza trial)"""
@@ -318,22 +1124,29 @@ def activar_suscripcion(user_phone):
     guardar_suscripcion_persistente(user_phone, sub_data)
     
     # 2. Actualizar trial para marcar como suscriptor
-    trials = cargar_trials_persistentes()
-    if user_phone in trials:
-        trials[user_phone]['is_subscribed'] = True
-        trials[user_phone]['actualizado_en'] = datetime.now().isoformat()
-        guardar_trials_persistentes(trials)
+    def marcar_suscriptor(trial):
+        if trial is None:
+            return None
+        trial['is_subscribed'] = True
+        trial['actualizado_en'] = datetime.now().isoformat()
+        return trial
+    almacen.actualizar(COLECCION_TRIALS, user_phone, marcar_suscriptor)
+    
+    # 3. Programar sus recordatorios de vencimiento
+    programador_recordatorios.programar(user_phone, sub_data)
+    
+    # 4. El acceso cacheado de este teléfono ya no es válido
+    cache_derechos.invalidar(user_phone)
     
     return sub_data
 
 def verificar_suscripcion_activa(user_phone):
     """Verifica suscripción activa (PERSISTENTE)"""
-    subs = cargar_suscripciones_persistentes()
+    sub = almacen.obtener(COLECCION_SUSCRIPCIONES, user_phone)
     
-    if user_phone not in subs:
+    if sub is None:
         return False
     
-    sub = subs[user_phone]
     fecha_vencimiento = datetime.strptime(sub['fecha_vencimiento'], '%Y-%m-%d').date()
     hoy = datetime.now().date()
     
@@ -346,12 +1159,11 @@ def verificar_suscripcion_activa(user_phone):
 
 def dias_restantes_suscripcion(user_phone):
     """Días restantes de suscripción (PERSISTENTE)"""
-    subs = cargar_suscripciones_persistentes()
+    sub = almacen.obtener(COLECCION_SUSCRIPCIONES, user_phone)
     
-    if user_phone not in subs:
+    if sub is None:
         return 0
     
-    sub = subs[user_phone]
     fecha_vencimiento = datetime.strptime(sub['fecha_vencimiento'], '%Y-%m-%d').date()
     hoy = datetime.now().date()
     
@@ -359,122 +1171,490 @@ def dias_restantes_suscripcion(user_phone):
 
 # --- SISTEMA UNIFICADO DE ACCESO ---
 
-def usuario_puede_chatear(user_phone):
-    """Verificación unificada de acceso (PERSISTENTE)"""
+def calcular_derechos(user_phone):
+    """Estado de acceso leído del almacén (fechas parseadas; puede marcar 'vencido')"""
     # 1. Primero verificar suscripción pagada
     if verificar_suscripcion_activa(user_phone):
-        return True
-    
+        tipo, dias = 'pagado', dias_restantes_suscripcion(user_phone)
     # 2. Luego verificar trial activo
-    if verificar_trial_activo(user_phone):
-        return True
-    
-    return False
+    elif verificar_trial_activo(user_phone):
+        tipo, dias = 'trial', dias_restantes_trial(user_phone)
+    else:
+        tipo, dias = 'bloqueado', 0
+    return DerechosAcceso(tipo, dias, usuario_ya_uso_sesion_hoy(user_phone))
+
+@metricas.medido('acceso')
+def usuario_puede_chatear(user_phone):
+    """Verificación unificada de acceso (PERSISTENTE, cacheada hasta medianoche)"""
+    return obtener_derechos(user_phone).tipo != 'bloqueado'
 
 # --- SISTEMA DE RECORDATORIOS AUTOMÁTICOS (PERSISTENTE) ---
 
-def ejecutar_recordatorios_automaticos():
-    """Envía recordatorios automáticos de suscripción (PERSISTENTE)"""
-    def tarea_background():
-        while True:
-            try:
-                hoy = datetime.now().date()
-                print(f"🔔 Verificando recordatorios para {hoy}")
-                
-                subs = cargar_suscripciones_persistentes()
-                subs_actualizados = False
-                
-                for user_phone, sub in subs.items():
-                    if sub['estado'] != 'activo':
-                        continue
-                        
-                    fecha_vencimiento = datetime.strptime(sub['fecha_vencimiento'], '%Y-%m-%d').date()
-                    dias_restantes = (fecha_vencimiento - hoy).days
-                    
-                    if dias_restantes == 7 and not sub.get('recordatorio_7d_enviado', False):
-                        mensaje = f"""
+# --- PROGRAMADOR DE RECORDATORIOS DE VENCIMIENTO ---
+HORA_RECORDATORIOS = int(os.getenv('ALMA_HORA_RECORDATORIOS', 9))
+# Relectura periódica del almacén (suscripciones activadas desde otro worker o proceso)
+RECORDATORIOS_SINCRONIZAR_SEGUNDOS = int(os.getenv('ALMA_RECORDATORIOS_SINCRONIZAR_SEGUNDOS', 6 * 3600))
+RECORDATORIOS_REINTENTO_SEGUNDOS = 900
+
+# Días antes del vencimiento -> (bandera de entrega en la suscripción, mensaje)
+PLANTILLAS_RECORDATORIO = {
+    7: ('recordatorio_7d_enviado', """
 🔔 **Recordatorio de Suscripción**
 
-📅 Tu suscripción de Alma vence en **7 días** ({fecha_vencimiento.strftime('%d/%m/%Y')})
+📅 Tu suscripción de Alma vence en **7 días** ({fecha})
 
 Para renovar y evitar interrupciones en tu acompañamiento:
 • Envía "RENOVAR" para recibir los datos de pago
 
 🌱 *Tu bienestar emocional es nuestra prioridad*
-"""
-                        enviar_respuesta_twilio(mensaje, user_phone)
-                        sub['recordatorio_7d_enviado'] = True
-                        subs_actualizados = True
-                        print(f"📤 Recordatorio 7d enviado a {user_phone}")
-                        
-                    elif dias_restantes == 3 and not sub.get('recordatorio_3d_enviado', False):
-                        mensaje = f"""
+"""),
+    3: ('recordatorio_3d_enviado', """
 ⚠️ **Recordatorio Urgente**
 
-📅 Tu suscripción de Alma vence en **3 días** ({fecha_vencimiento.strftime('%d/%m/%Y')})
+📅 Tu suscripción de Alma vence en **3 días** ({fecha})
 
 🔄 Renueva ahora para mantener tu acceso continuo:
 • Envía "RENOVAR" para datos de pago
 
 💫 *No pierdas tu ritmo de crecimiento*
-"""
-                        enviar_respuesta_twilio(mensaje, user_phone)
-                        sub['recordatorio_3d_enviado'] = True
-                        subs_actualizados = True
-                        print(f"📤 Recordatorio 3d enviado a {user_phone}")
-                        
-                    elif dias_restantes == 0 and not sub.get('recordatorio_0d_enviado', False):
-                        mensaje = f"""
+"""),
+    0: ('recordatorio_0d_enviado', """
 🚨 **Suscripción por Vencer Hoy**
 
-📅 **Hoy {fecha_vencimiento.strftime('%d/%m/%Y')}** vence tu suscripción de Alma
+📅 **Hoy {fecha}** vence tu suscripción de Alma
 
 ⚡ Actúa ahora para mantener tu acceso:
 • Envía "RENOVAR" inmediatamente
 
 🌿 *Tu camino de mindfulness es importante*
-"""
-                        enviar_respuesta_twilio(mensaje, user_phone)
-                        sub['recordatorio_0d_enviado'] = True
-                        subs_actualizados = True
-                        print(f"📤 Recordatorio 0d enviado a {user_phone}")
-                
-                # Guardar cambios si hubo actualizaciones
-                if subs_actualizados:
-                    guardar_json_safe(PAID_SUBS_FILE, subs)
-                    print("💾 Suscripciones actualizadas después de recordatorios")
-                
-                time.sleep(3600)  # Revisar cada hora
-                
-            except Exception as e:
-                print(f"❌ Error en recordatorios automáticos: {e}")
-                time.sleep(300)  # Reintentar en 5 minutos
-    
-    thread = Thread(target=tarea_background, daemon=True)
-    thread.start()
-    print("✅ Sistema de recordatorios automáticos INICIADO (PERSISTENTE)")
-
-# --- FUNCIONES DE SESIÓN EN MEMORIA ---
+"""),
+}
+
+class ProgramadorRecordatorios:
+    """Heap de recordatorios ordenado por momento de envío: el hilo duerme hasta el siguiente
+    en lugar de revisar a todos los suscriptores cada hora"""
+
+    def __init__(self):
+        self.heap = []              # (momento, user_phone, dias, fecha_vencimiento)
+        self.programados = set()    # (user_phone, dias, fecha_vencimiento) ya en el heap
+        self.condicion = Condition()
+        self.proxima_sincronizacion = 0
+        self.enviados = 0
+        self.fallidos = 0
+
+    def programar(self, user_phone, sub):
+        """Agrega los recordatorios pendientes de una suscripción (idempotente)"""
+        if sub.get('estado') != 'activo':
+            return
+        vencimiento = date.fromisoformat(sub['fecha_vencimiento'])
+        hoy = date.today()
+        with self.condicion:
+            for dias, (bandera, _) in PLANTILLAS_RECORDATORIO.items():
+                dia_envio = vencimiento - timedelta(days=dias)
+                clave = (user_phone, dias, sub['fecha_vencimiento'])
+                if dia_envio < hoy or sub.get(bandera) or clave in self.programados:
+                    continue
+                momento = datetime(dia_envio.year, dia_envio.month, dia_envio.day,
+                                   HORA_RECORDATORIOS).timestamp()
+                self.programados.add(clave)
+                heapq.heappush(self.heap, (momento,) + clave)
+            self.condicion.notify()
+
+    def sincronizar(self):
+        """Solo lee las suscripciones que vencen en los próximos 7 días (consulta por rango)"""
+        # Antes de la consulta: si falla, no se reintenta en cada pasada
+        self.proxima_sincronizacion = time.time() + RECORDATORIOS_SINCRONIZAR_SEGUNDOS
+        for user_phone, sub in almacen.suscripciones_por_vencer(max(PLANTILLAS_RECORDATORIO)).items():
+            self.programar(user_phone, sub)
+
+    def extraer_vencidos(self):
+        ahora = time.time()
+        vencidos = []
+        with self.condicion:
+            while self.heap and self.heap[0][0] <= ahora:
+                entrada = heapq.heappop(self.heap)
+                self.programados.discard(entrada[1:])
+                vencidos.append(entrada)
+        return vencidos
+
+    def enviar(self, vencidos):
+        """Envía en lote y marca cada recordatorio entregado en su suscripción"""
+        hoy = date.today()
+        recordatorios = {}
+        for _, user_phone, dias, fecha_vencimiento in vencidos:
+            bandera, plantilla = PLANTILLAS_RECORDATORIO[dias]
+            vencimiento = date.fromisoformat(fecha_vencimiento)
+            # Se relee la suscripción: pudo renovarse, cancelarse o recibir ya el recordatorio
+            sub = almacen.obtener(COLECCION_SUSCRIPCIONES, user_phone)
+            if (sub is None or sub['estado'] != 'activo' or sub.get(bandera)
+                    or sub['fecha_vencimiento'] != fecha_vencimiento
+                    or (vencimiento - hoy).days != dias):
+                continue
+            mensaje = plantilla.format(fecha=vencimiento.strftime('%d/%m/%Y'))
+            recordatorios.setdefault(user_phone, (mensaje, dias, fecha_vencimiento))
+
+        resultados = enviar_lote_twilio([(phone, r[0]) for phone, r in recordatorios.items()])
+        for user_phone, (_, dias, fecha_vencimiento) in recordatorios.items():
+            bandera = PLANTILLAS_RECORDATORIO[dias][0]
+            if not resultados.get(user_phone):
+                # Se reintenta más tarde (solo se envía si sigue siendo el día del recordatorio)
+                self.fallidos += 1
+                with self.condicion:
+                    if (user_phone, dias, fecha_vencimiento) not in self.programados:
+                        self.programados.add((user_phone, dias, fecha_vencimiento))
+                        heapq.heappush(self.heap, (time.time() + RECORDATORIOS_REINTENTO_SEGUNDOS,
+                                                   user_phone, dias, fecha_vencimiento))
+                continue
+
+            def marcar_entregado(sub, bandera=bandera, fecha_vencimiento=fecha_vencimiento):
+                if sub is None or sub['fecha_vencimiento'] != fecha_vencimiento or sub.get(bandera):
+                    return None
+                sub[bandera] = True
+                return sub
+            almacen.actualizar(COLECCION_SUSCRIPCIONES, user_phone, marcar_entregado)
+            self.enviados += 1
+            print(f"📤 {bandera.replace('_enviado', '')} enviado a {user_phone}")
+        if recordatorios:
+            print("💾 Suscripciones actualizadas después de recordatorios")
+
+    def segundos_hasta_siguiente(self):
+        with self.condicion:
+            espera = self.proxima_sincronizacion - time.time()
+            if self.heap:
+                espera = min(espera, self.heap[0][0] - time.time())
+            return max(espera, 0)
+
+    def ciclo(self):
+        """Una pasada: sincroniza si toca y envía los vencidos; devuelve segundos hasta la próxima"""
+        if time.time() >= self.proxima_sincronizacion:
+            self.sincronizar()
+        vencidos = self.extraer_vencidos()
+        if vencidos:
+            self.enviar(vencidos)
+        return self.segundos_hasta_siguiente()
+
+    def esperar(self, segundos):
+        """Duerme hasta el siguiente recordatorio; programar() lo despierta antes si hace falta.
+
+        Nunca menos de `segundos` (p. ej. la pausa de TareaFondo tras un error).
+        """
+        with self.condicion:
+            espera = max(segundos, self.segundos_hasta_siguiente())
+            if espera > 0:
+                self.condicion.wait(espera)
+
+    def estado(self):
+        with self.condicion:
+            return {
+                "programados": len(self.heap),
+                "proximo": datetime.fromtimestamp(self.heap[0][0]).isoformat() if self.heap else None,
+                "enviados": self.enviados,
+                "fallidos": self.fallidos,
+            }
+
+programador_recordatorios = ProgramadorRecordatorios()
+
+# --- ALMACÉN DE SESIONES DE CONVERSACIÓN ---
+# 'memoria': diccionario del proceso (un solo worker)
+# 'sqlite':  archivo compartido por todos los workers de gunicorn, sobrevive reinicios
+SESSION_STORE = os.getenv('ALMA_SESSION_STORE', 'memoria')
+SESSION_STORE_FILE = os.getenv('ALMA_SESSION_STORE_PATH', 'alma_sesiones.db')
+SESION_TTL_SEGUNDOS = int(os.getenv('ALMA_SESION_TTL_SEGUNDOS', 7 * 86400))
+# Tope de sesiones retenidas: al superarlo se descartan las de contacto más antiguo (0 = sin tope)
+SESIONES_MAXIMO = int(os.getenv('ALMA_SESIONES_MAXIMO', 0))
+LIMPIEZA_INTERVALO_SEGUNDOS = int(os.getenv('ALMA_LIMPIEZA_INTERVALO_SEGUNDOS', 60))
+
+class AlmacenSesiones(ABC):
+    """Interfaz de almacenamiento de sesiones de conversación con expiración por inactividad"""
+
+    @abstractmethod
+    def obtener(self, user_phone):
+        """Sesión vigente del usuario o None (las vencidas no se devuelven)"""
+
+    @abstractmethod
+    def guardar(self, user_phone, session):
+        ...
+
+    @abstractmethod
+    def actualizar(self, user_phone, funcion):
+        """Lectura-modificación-escritura atómica de la sesión, también entre procesos.
+
+        funcion recibe la sesión vigente (o None) y devuelve la sesión a guardar,
+        o None para dejarla como está.
+        """
+
+    @abstractmethod
+    def eliminar(self, user_phone):
+        ...
+
+    @abstractmethod
+    def contar(self):
+        ...
+
+    @abstractmethod
+    def expirar(self):
+        """Elimina las sesiones vencidas; devuelve cuántas se eliminaron"""
+
+# Turnos que se conservan por sesión (los más antiguos se descartan solos)
+LIMITE_HISTORIAL = 10
+
+TurnoConversacion = namedtuple('TurnoConversacion', ['user', 'alma', 'timestamp', 'comercial'])
+
+def marca_tiempo(valor):
+    """Epoch en segundos; acepta también las fechas ISO de sesiones guardadas antes"""
+    if isinstance(valor, str):
+        return datetime.fromisoformat(valor).timestamp()
+    return valor
+
+class SesionUsuario:
+    """Sesión de conversación compacta: __slots__, marcas de tiempo numéricas e historial acotado"""
+
+    __slots__ = ('historial', 'created_at', 'session_start_time',
+                 'recordatorio_enviado', 'crisis_count', 'last_contact',
+                 'turnos_totales', 'resumen', 'resumidos_hasta')
+
+    def __init__(self, ahora=None):
+        ahora = ahora or time.time()
+        # El deque se crea con el primer turno: la mayoría de las sesiones retenidas están inactivas
+        self.historial = None
+        self.created_at = ahora
+        self.session_start_time = ahora
+        self.recordatorio_enviado = False
+        self.crisis_count = 0
+        self.last_contact = ahora
+        # Resumen incremental: cubre los turnos [0, resumidos_hasta) de la sesión
+        self.turnos_totales = 0
+        self.resumen = None
+        self.resumidos_hasta = 0
+
+    @property
+    def conversation_history(self):
+        return self.historial if self.historial is not None else ()
+
+    def agregar_turno(self, user, alma, comercial, timestamp=None):
+        if self.historial is None:
+            self.historial = deque(maxlen=LIMITE_HISTORIAL)
+        self.historial.append(TurnoConversacion(user, alma, timestamp or time.time(), comercial))
+        self.turnos_totales += 1
+
+    def turnos_sin_resumir(self):
+        """Turnos del historial que todavía no cubre el resumen"""
+        primero = self.turnos_totales - len(self.conversation_history)
+        return list(self.conversation_history)[max(self.resumidos_hasta - primero, 0):]
+
+    def a_dict(self):
+        datos = {campo: getattr(self, campo) for campo in self.__slots__ if campo != 'historial'}
+        datos['conversation_history'] = [turno._asdict() for turno in self.conversation_history]
+        return datos
+
+    @classmethod
+    def desde_dict(cls, datos):
+        session = cls()
+        session.created_at = marca_tiempo(datos['created_at'])
+        session.session_start_time = datos['session_start_time']
+        session.recordatorio_enviado = datos.get('recordatorio_enviado', False)
+        session.crisis_count = datos.get('crisis_count', 0)
+        session.last_contact = marca_tiempo(datos['last_contact'])
+        for t in datos['conversation_history']:
+            session.agregar_turno(t['user'], t['alma'], t.get('comercial'), marca_tiempo(t['timestamp']))
+        session.turnos_totales = datos.get('turnos_totales', session.turnos_totales)
+        session.resumen = datos.get('resumen')
+        session.resumidos_hasta = datos.get('resumidos_hasta', 0)
+        return session
+
+def sesion_vencida(session, ahora=None):
+    ahora = ahora or time.time()
+    return ahora - session.last_contact > SESION_TTL_SEGUNDOS
+
+class IndiceExpiracion:
+    """Min-heap de (marca, clave) con borrado perezoso: reprogramar no busca la entrada vieja,
+    se descarta al salir del heap si ya no coincide con la marca vigente de la clave"""
+
+    def __init__(self):
+        self.heap = []
+        self.marcas = {}
+
+    def __len__(self):
+        return len(self.marcas)
+
+    def programar(self, clave, marca):
+        """O(log n): la entrada anterior de la clave queda obsoleta en el heap"""
+        self.marcas[clave] = marca
+        heapq.heappush(self.heap, (marca, clave))
+        # Demasiadas entradas obsoletas: reconstruir con solo las vigentes
+        if len(self.heap) > 2 * len(self.marcas) + 64:
+            self.heap = [(m, c) for c, m in self.marcas.items()]
+            heapq.heapify(self.heap)
+
+    def quitar(self, clave):
+        self.marcas.pop(clave, None)
+
+    def extraer_minimo(self):
+        """Clave vigente con la marca más baja (o None si está vacío)"""
+        while self.heap:
+            marca, clave = heapq.heappop(self.heap)
+            if self.marcas.get(clave) == marca:
+                del self.marcas[clave]
+                return clave
+        return None
+
+    def extraer_hasta(self, limite):
+        """Claves vigentes con marca <= limite, de la más antigua a la más reciente"""
+        extraidas = []
+        while self.heap and self.heap[0][0] <= limite:
+            marca, clave = heapq.heappop(self.heap)
+            if self.marcas.get(clave) == marca:
+                del self.marcas[clave]
+                extraidas.append(clave)
+        return extraidas
+
+class AlmacenSesionesMemoria(AlmacenSesiones):
+    """Sesiones en un diccionario del proceso, con índice de expiración por last_contact"""
+
+    def __init__(self, maximo=SESIONES_MAXIMO):
+        self.sesiones = {}
+        self.expiracion = IndiceExpiracion()
+        self.maximo = maximo
+        self.lock = Lock()
+
+    def obtener(self, user_phone):
+        session = self.sesiones.get(user_phone)
+        if session is not None and sesion_vencida(session):
+            self.eliminar(user_phone)
+            return None
+        return session
+
+    def guardar(self, user_phone, session):
+        with self.lock:
+            self.insertar(user_phone, session)
+
+    def insertar(self, user_phone, session):
+        """Requiere self.lock"""
+        self.sesiones[user_phone] = session
+        self.expiracion.programar(user_phone, session.last_contact)
+        # Tope LRU: se descartan las sesiones con el contacto más antiguo
+        while self.maximo and len(self.sesiones) > self.maximo:
+            self.sesiones.pop(self.expiracion.extraer_minimo(), None)
+
+    def actualizar(self, user_phone, funcion):
+        with self.lock:
+            session = self.sesiones.get(user_phone)
+            if session is not None and sesion_vencida(session):
+                session = None
+            nueva = funcion(session)
+            if nueva is not None:
+                self.insertar(user_phone, nueva)
+            return nueva
+
+    def eliminar(self, user_phone):
+        with self.lock:
+            self.sesiones.pop(user_phone, None)
+            self.expiracion.quitar(user_phone)
+
+    def contar(self):
+        return len(self.sesiones)
+
+    def expirar(self):
+        """O(k log n) para las k sesiones vencidas; no recorre las vigentes"""
+        with self.lock:
+            vencidas = self.expiracion.extraer_hasta(time.time() - SESION_TTL_SEGUNDOS)
+            for phone in vencidas:
+                self.sesiones.pop(phone, None)
+        return len(vencidas)
+
+class AlmacenSesionesSQLite(BaseDatosSQLite, AlmacenSesiones):
+    """Sesiones compartidas entre workers en un archivo SQLite (con índice de expiración)"""
+
+    def __init__(self, ruta):
+        super().__init__(ruta)
+        with self.transaccion() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS sesiones_conversacion "
+                         "(phone TEXT PRIMARY KEY, datos TEXT NOT NULL, expira_en REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_sesiones_expira "
+                         "ON sesiones_conversacion (expira_en)")
+
+    def obtener(self, user_phone):
+        fila = self.conexion().execute(
+            "SELECT datos FROM sesiones_conversacion WHERE phone = ? AND expira_en > ?",
+            (user_phone, time.time())).fetchone()
+        return SesionUsuario.desde_dict(json.loads(fila[0])) if fila else None
+
+    def guardar(self, user_phone, session):
+        with self.transaccion() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sesiones_conversacion (phone, datos, expira_en) "
+                "VALUES (?, ?, ?)",
+                (user_phone, json.dumps(session.a_dict(), ensure_ascii=False),
+                 time.time() + SESION_TTL_SEGUNDOS))
+
+    def actualizar(self, user_phone, funcion):
+        with self.transaccion() as conn:
+            fila = conn.execute(
+                "SELECT datos FROM sesiones_conversacion WHERE phone = ? AND expira_en > ?",
+                (user_phone, time.time())).fetchone()
+            nueva = funcion(SesionUsuario.desde_dict(json.loads(fila[0])) if fila else None)
+            if nueva is not None:
+                conn.execute(
+                    "INSERT OR REPLACE INTO sesiones_conversacion (phone, datos, expira_en) "
+                    "VALUES (?, ?, ?)",
+                    (user_phone, json.dumps(nueva.a_dict(), ensure_ascii=False),
+                     nueva.last_contact + SESION_TTL_SEGUNDOS))
+            return nueva
+
+    def eliminar(self, user_phone):
+        with self.transaccion() as conn:
+            conn.execute("DELETE FROM sesiones_conversacion WHERE phone = ?", (user_phone,))
+
+    def contar(self):
+        return self.conexion().execute(
+            "SELECT COUNT(*) FROM sesiones_conversacion WHERE expira_en > ?",
+            (time.time(),)).fetchone()[0]
+
+    def expirar(self):
+        with self.transaccion() as conn:
+            eliminadas = conn.execute("DELETE FROM sesiones_conversacion WHERE expira_en <= ?",
+                                      (time.time(),)).rowcount
+            if SESIONES_MAXIMO:
+                # Tope LRU: expira_en crece con last_contact, el índice da las más antiguas
+                eliminadas += conn.execute(
+                    "DELETE FROM sesiones_conversacion WHERE phone IN ("
+                    "SELECT phone FROM sesiones_conversacion ORDER BY expira_en "
+                    "LIMIT MAX((SELECT COUNT(*) FROM sesiones_conversacion) - ?, 0))",
+                    (SESIONES_MAXIMO,)).rowcount
+            return eliminadas
+
+def crear_almacen_sesiones():
+    if SESSION_STORE == 'sqlite':
+        return AlmacenSesionesSQLite(SESSION_STORE_FILE)
+    return AlmacenSesionesMemoria()
+
+almacen_sesiones = crear_almacen_sesiones()
+
+# --- FUNCIONES DE SESIÓN ---
 
 def get_user_session(user_phone):
-    if user_phone not in user_sessions:
-        user_sessions[user_phone] = {
-            'conversation_history': [],
-            'created_at': datetime.now().isoformat(),
-            'session_start_time': datetime.now().timestamp(), 
-            'recordatorio_enviado': False,                     
-            'crisis_count': 0,
-            'last_contact': datetime.now().isoformat()
-        }
-    return user_sessions[user_phone]
+    session = almacen_sesiones.obtener(user_phone)
+    if session is None:
+        session = SesionUsuario()
+        almacen_sesiones.guardar(user_phone, session)
+    return session
 
 def save_user_session(user_phone, session):
-    session['last_contact'] = datetime.now().isoformat()
-    user_sessions[user_phone] = session
+    session.last_contact = time.time()
+
+    def fusionar(actual):
+        # Un resumen aplicado en segundo plano mientras se generaba la respuesta no se pierde
+        if (actual is not None and actual is not session
+                and actual.session_start_time == session.session_start_time
+                and actual.resumidos_hasta > session.resumidos_hasta):
+            session.resumen = actual.resumen
+            session.resumidos_hasta = actual.resumidos_hasta
+        return session
+    almacen_sesiones.actualizar(user_phone, fusionar)
 
 def puede_iniciar_sesion(session, user_phone):
     """Verifica límites de tiempo por sesión"""
-    tiempo_transcurrido = datetime.now().timestamp() - session['session_start_time']
+    tiempo_transcurrido = time.time() - session.session_start_time
     minutos_transcurridos = tiempo_transcurrido / 60
     
     if minutos_transcurridos >= LIMITE_SESION_MAXIMO_MINUTOS:
@@ -487,121 +1667,509 @@ def puede_iniciar_sesion(session, user_phone):
 
 def debe_recordar_cierre(session):
     """Sistema de recordatorios más natural y menos invasivo"""
-    if session.get('recordatorio_enviado', False):
+    if session.recordatorio_enviado:
         return False
     
-    start_time = session['session_start_time']
-    current_time = datetime.now().timestamp()
+    start_time = session.session_start_time
+    current_time = time.time()
     tiempo_transcurrido_minutos = (current_time - start_time) / 60
     
     # Recordatorio SUAVE a los 45 minutos (15 min antes)
     if tiempo_transcurrido_minutos >= INTERVALO_RECORDATORIO_SUAVE_MINUTOS:
-        session['recordatorio_enviado'] = True
+        session.recordatorio_enviado = True
         return "suave"
     
     # Recordatorio FINAL a los 50 minutos (10 min antes)
     if tiempo_transcurrido_minutos >= INTERVALO_RECORDATORIO_MINUTOS:
-        session['recordatorio_enviado'] = True
+        session.recordatorio_enviado = True
         return "final"
     
     return False
 
 # --- DETECCIÓN DE CRISIS PRECISA Y CONSERVADORA ---
+
+# Frases que solo cuentan como palabra completa al final (p. ej. "matarme" pero no "matarmela")
+FRASES_CRISIS_PALABRA_COMPLETA = [
+    "suicidarme",
+    "matarme",
+    "ahorcarme",
+    "colgarme",
+    "dispararme"
+]
+
+# Frases que requieren contexto suicida explícito (coinciden en cualquier parte)
+FRASES_CRISIS_EXPLICITAS = [
+    "quiero suicidarme",
+    "me voy a suicidar",
+    "voy a suicidarme",
+    "quitarme la vida",
+    "acabar con mi vida",
+    "pensando en suicidarme",
+    "planeo suicidarme",
+    "saltar de un edificio",
+    "tirarme de un puente",
+    "darme un tiro",
+    "cortarme las venas"
+]
+
+CoincidenciaCrisis = namedtuple('CoincidenciaCrisis', ['frase', 'inicio', 'fin'])
+
+def normalizar_texto(texto):
+    """Minúsculas, sin acentos/diacríticos y con espacios colapsados"""
+    texto = unicodedata.normalize('NFKD', texto.lower())
+    texto = ''.join(c for c in texto if not unicodedata.combining(c))
+    return ' '.join(texto.split())
+
+FIN_DE_PALABRA = '\x00'
+
+def regex_trie(frases, frases_palabra_completa=()):
+    """Construye una sola regex factorizada por prefijos (trie) para todas las frases.
+
+    En cada posición del mensaje solo se exploran las ramas cuyo prefijo coincide,
+    así el costo casi no crece al agregar frases.
+    """
+    trie = {}
+    for frase, palabra_completa in ([(f, False) for f in frases] +
+                                    [(f, True) for f in frases_palabra_completa]):
+        nodo = trie
+        for caracter in frase:
+            nodo = nodo.setdefault(caracter, {})
+        if palabra_completa:
+            nodo = nodo.setdefault(FIN_DE_PALABRA, {})
+        nodo[''] = True
+
+    def generar(nodo):
+        ramas = [
+            (r'\b' if caracter == FIN_DE_PALABRA else re.escape(caracter)) + generar(hijo)
+            for caracter, hijo in sorted(nodo.items()) if caracter != ''
+        ]
+        if not ramas:
+            return ''
+        cuerpo = ramas[0] if len(ramas) == 1 else '(?:' + '|'.join(ramas) + ')'
+        # Un nodo terminal hace opcional todo lo que sigue
+        return f'(?:{cuerpo})?' if '' in nodo else cuerpo
+
+    return generar(trie)
+
+def compilar_detector_crisis(frases, frases_palabra_completa=()):
+    """Compila (una vez) el detector sobre frases normalizadas"""
+    frases = sorted({normalizar_texto(f) for f in frases})
+    completas = sorted({normalizar_texto(f) for f in frases_palabra_completa})
+    return re.compile(regex_trie(frases, completas))
+
+DETECTOR_CRISIS = compilar_detector_crisis(
+    FRASES_CRISIS_EXPLICITAS + TRIGGER_CRISIS, FRASES_CRISIS_PALABRA_COMPLETA)
+
+def buscar_crisis(user_message, detector=None):
+    """Primera frase de crisis en el mensaje normalizado, con su posición, o None"""
+    mensaje = normalizar_texto(user_message)
+    coincidencia = (detector or DETECTOR_CRISIS).search(mensaje)
+    if coincidencia is None:
+        return None
+    return CoincidenciaCrisis(coincidencia.group(0), coincidencia.start(), coincidencia.end())
+
+@metricas.medido('crisis')
 def detectar_crisis_real(user_message):
     """
     Detección MUY conservadora - solo activa con suicidio explícito
     No activa con expresiones de desahogo emocional normales
     """
-    mensaje = user_message.lower().strip()
+    coincidencia = buscar_crisis(user_message)
+    if coincidencia:
+        # No se registra el mensaje completo, solo la frase detectada
+        print(f"🚨 CRISIS DETECTADA: '{coincidencia.frase}' en posición {coincidencia.inicio}")
+        return True
+    return False
+
+# --- SISTEMA MEJORADO DE DETECCIÓN DE SUSCRIPCIÓN ---
+
+# Palabras clave con ponderación (coinciden como subcadena del mensaje)
+PALABRAS_CLAVE_COMERCIALES = {
+    'cuanto': 3, 'cuánto': 3, 'precio': 3, 'costo': 3, 'valor': 2,
+    'pagar': 3, 'pago': 3, 'suscripción': 4, 'suscripcion': 4,
+    'cuenta': 2, 'banco': 2, 'clabe': 3, 'transferencia': 2,
+    'depositar': 2, 'comprar': 2, 'contratar': 2, 'plan': 2,
+    'membresía': 3, 'membresia': 3, 'datos bancarios': 4,
+    'información de pago': 4, 'forma de pago': 3,
+    'abonar': 2, 'depósito': 2, 'deposito': 2, 'renovar': 2,
+    'actualizar': 2, 'registrarme': 2, 'darme de alta': 3,
+    'gratis': 3, 'gratuito': 3, 'sin costo': 4, 'sin pago': 3 
+}
+
+# Palabras que marcan un turno del historial como comercial
+PALABRAS_CONTEXTO_COMERCIAL = [
+    'precio', 'pago', 'suscripción', 'cuanto', 'costo', 'banco',
+    'cuenta', 'transferencia', 'depósito'
+]
+
+PREFIJOS_PREGUNTA_DIRECTA = ('cuanto', 'cuánto', 'cómo', 'como', 'dónde', 'donde', 'qué', 'que')
+
+UMBRAL_INTENCION_COMERCIAL = 4  # Umbral más bajo para mejor detección
+
+TRIGGERS_SUSCRIPCION = [
+    # DATOS Y INFORMACIÓN
+    "datos de suscripción", "datos para suscripción", "datos para suscribirse",
+    "datos para suscribirme", "datos de pago", "datos para pago", "datos para pagar",
+    "datos bancarios", "número de cuenta", "clabe interbancaria", "cuenta para pagar",
+    "cuenta de depósito", "datos para transferencia", "datos para depósito",
+    "información de pago", "datos para abonar", "datos para enviar dinero",
     
-    # Patrones que requieren contexto suicida explícito
-    patrones_suicidio_explicito = [
-        r"quiero suicidarme",
-        r"me voy a suicidar", 
-        r"voy a suicidarme",
-        r"suicidarme\b",
-        r"matarme\b",
-        r"quitarme la vida",
-        r"acabar con mi vida",
-        r"pensando en suicidarme",
-        r"planeo suicidarme",
-        r"saltar de un edificio",
-        r"tirarme de un puente",
-        r"ahorcarme\b",
-        r"colgarme\b",
-        r"dispararme\b",
-        r"darme un tiro",
-        r"cortarme las venas"
-    ]
+    # SUSCRIPCIÓN Y REGISTRO
+    "cómo suscribirme", "cómo me suscribo", "cómo me doy de alta", "quiero suscribirme",
+    "deseo suscribirme", "quiero registrarme", "quiero darme de alta", "activar mi suscripción",
+    "iniciar suscripción", "empezar mi suscripción", "contratar el servicio", "cómo contratar",
+    "cómo me uno", "cómo acceder al servicio", "cómo obtener acceso",
     
-    for patron in patrones_suicidio_explicito:
-        if re.search(patron, mensaje):
-            print(f"🚨 CRISIS DETECTADA: '{patron}' en mensaje: {mensaje}")
-            return True
+    # PAGO Y TRANSACCIONES
+    "cómo pago", "quiero pagar", "deseo pagar", "realizar el pago", "hacer el pago",
+    "pagar ahora", "cómo hacer el pago", "cómo abono", "cómo transferir", "cómo depositar",
+    "cómo hacer la transferencia", "cómo enviar el dinero", "cómo completar el pago",
+    "cómo pagar por transferencia", "cómo pagar por depósito",
     
-    # Verificación adicional con lista de triggers
-    for trigger in TRIGGER_CRISIS:
-        if trigger in mensaje:
-            print(f"🚨 CRISIS DETECTADA: '{trigger}' en mensaje: {mensaje}")
-            return True
+    # PRECIO Y COSTOS
+    "cuánto cuesta", "cuál es el precio", "formas de pago", "métodos de pago", 
+    "opciones de pago", "información de precio", "info de precio",
     
-    print(f"✅ No se detectó crisis - Mensaje normal: {mensaje[:50]}...")
-    return False
-
-# --- SISTEMA MEJORADO DE DETECCIÓN DE SUSCRIPCIÓN ---
+    # INFORMACIÓN GENERAL
+    "cómo funciona la suscripción", "qué necesito para suscribirme",
+    "información de pago", "info de pago", "información para pago", "info para pago",
+    "información para pagar", "info para pagar", "información de alta", "info de alta",
+    "información de depósito", "info de depósito", "información para depositar",
+    "info para depositar", "información de suscripción", "info de suscripción",
+    "información para suscripción", "info para suscripción", "información para suscribirse",
+    "info para suscribirse", "información para suscribirme", "info para suscribirme",
+    
+    # RENOVACIÓN Y ACTUALIZACIÓN
+    "cómo renovar mi suscripción", "quiero renovar", "quiero actualizar mi plan",
+    
+    # GRATUIDAD (ahora incluido aquí)
+    "es gratis", "es gratuito", "no tiene costo", "es sin pago", "es free"
+]
 
-def analizar_intencion_comercial(user_message, conversation_history):
-    """Análisis más inteligente que considera contexto"""
-    message_lower = user_message.lower().strip()
+CONVERSACIONES_NATURALES = [
+    # PATRONES DE PREGUNTAS SOBRE PRECIO
+    ("cuanto", ["cuesta", "vale", "es", "hay que pagar", "debo pagar"]),
+    ("precio", ["de alma", "del servicio", "mensual", "anual", "tiene"]),
+    ("costo", ["del servicio", "de alma", "mensual", "tiene"]),
+    ("valor", ["del servicio", "de alma", "mensual"]),
     
-    # 1. Detectar palabras clave con ponderación
-    palabras_clave = {
-        'cuanto': 3, 'cuánto': 3, 'precio': 3, 'costo': 3, 'valor': 2,
-        'pagar': 3, 'pago': 3, 'suscripción': 4, 'suscripcion': 4,
-        'cuenta': 2, 'banco': 2, 'clabe': 3, 'transferencia': 2,
-        'depositar': 2, 'comprar': 2, 'contratar': 2, 'plan': 2,
-        'membresía': 3, 'membresia': 3, 'datos bancarios': 4,
-        'información de pago': 4, 'forma de pago': 3,
-        'abonar': 2, 'depósito': 2, 'deposito': 2, 'renovar': 2,
-        'actualizar': 2, 'registrarme': 2, 'darme de alta': 3,
-        'gratis': 3, 'gratuito': 3, 'sin costo': 4, 'sin pago': 3 
-    }
+    # PATRONES DE SUSCRIPCIÓN
+    ("suscripción", ["cómo", "como", "quiero", "deseo", "activar", "iniciar"]),
+    ("suscribir", ["me", "cómo", "como", "quiero", "deseo"]),
+    ("suscripcion", ["cómo", "como", "quiero", "deseo", "activar"]),
     
-    # Calcular puntuación
-    puntuacion = 0
-    for palabra, peso in palabras_clave.items():
-        if palabra in message_lower:
-            puntuacion += peso
+    # PATRONES DE PAGO
+    ("pago", ["cómo", "como", "dónde", "donde", "quiero", "deseo", "realizar"]),
+    ("pagar", ["cómo", "como", "dónde", "donde", "quiero", "deseo"]),
+    ("abonar", ["cómo", "como", "dónde", "donde"]),
+    ("transferir", ["cómo", "como", "dónde", "donde"]),
+    ("depositar", ["cómo", "como", "dónde", "donde"]),
     
-    # 2. Analizar contexto de la conversación
-    contexto_comercial = any(
-        any(palabra in msg['user'].lower() for palabra in [
-            'precio', 'pago', 'suscripción', 'cuanto', 'costo', 'banco',
-            'cuenta', 'transferencia', 'depósito'
-        ])
-        for msg in conversation_history[-3:]  # Últimos 3 mensajes
-    )
+    # PATRONES DE DATOS BANCARIOS
+    ("datos", ["bancarios", "de pago", "para pagar", "cuenta", "transferencia"]),
+    ("cuenta", ["bancaria", "para pagar", "depósito", "transferencia"]),
+    ("clabe", ["interbancaria", "para transferir"]),
+    ("banco", ["para depositar", "para transferir"]),
     
-    if contexto_comercial:
-        puntuacion += 2  # Bonus por contexto
+    # PATRONES DE INFORMACIÓN
+    ("información", ["de pago", "para pagar", "sobre precios", "suscripción"]),
+    ("info", ["de pago", "para pagar", "sobre precios", "suscripción"]),
     
-    # 3. Detectar preguntas directas
-    es_pregunta_directa = any(message_lower.startswith(prefix) for prefix in 
-                            ['cuanto', 'cuánto', 'cómo', 'como', 'dónde', 'donde', 'qué', 'que'])
+    # PATRONES DE ACCIÓN
+    ("quiero", ["pagar", "comprar", "contratar", "suscribirme", "registrarme"]),
+    ("deseo", ["pagar", "comprar", "contratar", "suscribirme", "registrarme"]),
+    ("necesito", ["pagar", "suscribirme", "información de pago"]),
     
-    if es_pregunta_directa and puntuacion > 0:
-        puntuacion += 2
+    # PATRONES DE MÉTODOS
+    ("método", ["de pago", "para pagar"]),
+    ("metodo", ["de pago", "para pagar"]),
+    ("forma", ["de pago", "para pagar"]),
+    ("opción", ["de pago", "para pagar"]),
+    ("opcion", ["de pago", "para pagar"]),
     
-    print(f"🔍 Análisis de intención: '{user_message}' -> Puntuación: {puntuacion}")
-    return puntuacion >= 4  # Umbral más bajo para mejor detección
+    # PATRONES DE RENOVACIÓN
+    ("renovar", ["mi suscripción", "suscripción", "cómo", "como"]),
+    ("actualizar", ["mi plan", "plan", "suscripción"])
+]
+
+# 🛡️ COMPROBANTES - SOLO con confirmación explícita de pago
+PALABRAS_COMPROBANTE = ["comprobante", "captura"]
+CONFIRMACIONES_PAGO = ["ya pagué", "pagué", "transferí", "deposité"]
+
+MENSAJE_COMPROBANTE_RECIBIDO = "📋 **Comprobante recibido**\nHemos registrado tu comprobante. Un administrador activará tu suscripción en las próximas 24 horas. ¡Gracias por confiar en Alma! 🌱"
+
+ResultadoIntencion = namedtuple('ResultadoIntencion', ['puntuacion', 'regla', 'etapa'])
+
+class AutomataFrases:
+    """Autómata Aho-Corasick: todas las frases contenidas en un texto en una sola pasada"""
+
+    def __init__(self, frases):
+        self.transiciones = [{}]
+        self.fallo = [0]
+        self.salidas = [()]
+        for frase in frases:
+            estado = 0
+            for caracter in frase:
+                siguiente = self.transiciones[estado].get(caracter)
+                if siguiente is None:
+                    siguiente = len(self.transiciones)
+                    self.transiciones[estado][caracter] = siguiente
+                    self.transiciones.append({})
+                    self.fallo.append(0)
+                    self.salidas.append(())
+                estado = siguiente
+            if frase not in self.salidas[estado]:
+                self.salidas[estado] += (frase,)
+
+        # Enlaces de fallo por anchura (BFS)
+        pendientes = deque(self.transiciones[0].values())
+        while pendientes:
+            estado = pendientes.popleft()
+            for caracter, hijo in self.transiciones[estado].items():
+                pendientes.append(hijo)
+                fallo = self.fallo[estado]
+                while fallo and caracter not in self.transiciones[fallo]:
+                    fallo = self.fallo[fallo]
+                destino = self.transiciones[fallo].get(caracter, 0)
+                self.fallo[hijo] = destino if destino != hijo else 0
+                self.salidas[hijo] += self.salidas[self.fallo[hijo]]
+
+    def buscar(self, texto):
+        """Conjunto de frases que aparecen como subcadena del texto"""
+        transiciones, fallo, salidas = self.transiciones, self.fallo, self.salidas
+        encontradas = set()
+        estado = 0
+        for caracter in texto:
+            while estado and caracter not in transiciones[estado]:
+                estado = fallo[estado]
+            estado = transiciones[estado].get(caracter, 0)
+            if salidas[estado]:
+                encontradas.update(salidas[estado])
+        return encontradas
+
+class IndiceIntencion:
+    """Índice precompilado de intención comercial (se construye una vez al importar).
+
+    Una sola pasada del autómata sobre el mensaje alimenta las cuatro etapas:
+    puntuación semántica, triggers específicos, conversaciones naturales y comprobantes.
+    """
+
+    def __init__(self, palabras_clave=PALABRAS_CLAVE_COMERCIALES,
+                 palabras_contexto=PALABRAS_CONTEXTO_COMERCIAL,
+                 triggers=TRIGGERS_SUSCRIPCION,
+                 naturales=CONVERSACIONES_NATURALES,
+                 comprobantes=PALABRAS_COMPROBANTE,
+                 confirmaciones=CONFIRMACIONES_PAGO):
+        self.pesos = dict(palabras_clave)
+        self.contexto = frozenset(palabras_contexto)
+        # Prioridad = posición en la lista original (gana el primero)
+        self.prioridad_trigger = {}
+        for i, trigger in enumerate(triggers):
+            self.prioridad_trigger.setdefault(trigger, i)
+        self.naturales = [(palabra, tuple(combos)) for palabra, combos in naturales]
+        self.reglas_por_palabra = {}
+        for i, (palabra, _) in enumerate(self.naturales):
+            self.reglas_por_palabra.setdefault(palabra, []).append(i)
+        self.comprobantes = frozenset(comprobantes)
+        self.confirmaciones = frozenset(confirmaciones)
+
+        frases = set(self.pesos) | self.contexto | set(self.prioridad_trigger)
+        frases |= self.comprobantes | self.confirmaciones
+        for palabra, combos in self.naturales:
+            frases.add(palabra)
+            frases.update(combos)
+        self.automata = AutomataFrases(sorted(frases))
+
+    def es_comercial(self, texto):
+        """¿El texto menciona vocabulario comercial? (para el contexto de los siguientes turnos)"""
+        return bool(self.automata.buscar(texto.lower()) & self.contexto)
+
+    def clasificar(self, user_message, contexto_comercial=False):
+        message_lower = user_message.lower().strip()
+        encontradas = self.automata.buscar(message_lower)
+
+        # 1. 🎯 ANÁLISIS SEMÁNTICO: palabras clave ponderadas + contexto + pregunta directa
+        puntuacion = sum(self.pesos[f] for f in encontradas if f in self.pesos)
+        if contexto_comercial:
+            puntuacion += 2  # Bonus por contexto
+        if puntuacion > 0 and message_lower.startswith(PREFIJOS_PREGUNTA_DIRECTA):
+            puntuacion += 2
+        if puntuacion >= UMBRAL_INTENCION_COMERCIAL:
+            return ResultadoIntencion(puntuacion, 'puntuacion', 'semantica')
+
+        # 2. 📋 TRIGGERS ESPECÍFICOS
+        triggers = [f for f in encontradas if f in self.prioridad_trigger]
+        if triggers:
+            return ResultadoIntencion(puntuacion, min(triggers, key=self.prioridad_trigger.get), 'trigger')
+
+        # 3. 💬 CONVERSACIONES NATURALES (solo las reglas cuya palabra apareció)
+        reglas = sorted(i for f in encontradas for i in self.reglas_por_palabra.get(f, ()))
+        for i in reglas:
+            palabra, combos = self.naturales[i]
+            for combo in combos:
+                if combo in encontradas:
+                    return ResultadoIntencion(puntuacion, f"{palabra} {combo}", 'natural')
+
+        # 4. 🛡️ COMPROBANTES - SOLO con confirmación explícita de pago
+        if encontradas & self.comprobantes and encontradas & self.confirmaciones:
+            return ResultadoIntencion(puntuacion, 'comprobante', 'comprobante')
+
+        return ResultadoIntencion(puntuacion, None, None)
+
+INDICE_INTENCION = IndiceIntencion()
+
+def contexto_comercial_reciente(conversation_history):
+    """Contexto comercial de los últimos 3 turnos usando la marca cacheada en cada turno"""
+    for turno in list(conversation_history)[-3:]:
+        comercial = turno.comercial
+        if comercial is None:
+            comercial = INDICE_INTENCION.es_comercial(turno.user)
+        if comercial:
+            return True
+    return False
+
+def analizar_intencion_comercial(user_message, conversation_history):
+    """Análisis más inteligente que considera contexto"""
+    resultado = INDICE_INTENCION.clasificar(user_message, contexto_comercial_reciente(conversation_history))
+    print(f"🔍 Análisis de intención -> Puntuación: {resultado.puntuacion}")
+    return resultado.etapa == 'semantica'
+
+# --- CACHÉ DE RESPUESTAS (PREGUNTAS FRECUENTES) ---
+CACHE_RESPUESTAS_MAXIMO = int(os.getenv('ALMA_CACHE_RESPUESTAS_MAXIMO', 1000))
+# Caché opcional de respuestas de DeepSeek a preguntas genéricas (evita la llamada)
+CACHE_FAQ = os.getenv('ALMA_CACHE_FAQ', '0') == '1'
+CACHE_FAQ_TTL_SEGUNDOS = int(os.getenv('ALMA_CACHE_FAQ_TTL_SEGUNDOS', 24 * 3600))
+
+class CacheTTL:
+    """LRU acotado con expiración por entrada; cuenta aciertos y fallos"""
+
+    def __init__(self, maximo, ttl):
+        self.maximo = maximo
+        self.ttl = ttl
+        self.entradas = OrderedDict()  # clave -> (expira_en, valor)
+        # Crece con cada invalidar(): un valor calculado antes de una invalidación no se guarda
+        self.generacion = 0
+        self.aciertos = 0
+        self.fallos = 0
+        self.lock = Lock()
+
+    def obtener(self, clave):
+        """Valor vigente o None"""
+        with self.lock:
+            entrada = self.entradas.get(clave)
+            if entrada is None or entrada[0] <= time.time():
+                if entrada is not None:
+                    del self.entradas[clave]
+                self.fallos += 1
+                return None
+            self.entradas.move_to_end(clave)
+            self.aciertos += 1
+            return entrada[1]
+
+    def guardar(self, clave, valor, ttl=None, generacion=None):
+        """generacion: la leída antes de calcular el valor (se descarta si hubo invalidaciones)"""
+        with self.lock:
+            if generacion is not None and generacion != self.generacion:
+                return
+            self.entradas[clave] = (time.time() + (self.ttl if ttl is None else ttl), valor)
+            self.entradas.move_to_end(clave)
+            while len(self.entradas) > self.maximo:
+                self.entradas.popitem(last=False)
+
+    def guardar_si_ausente(self, clave, valor=True):
+        """Guarda solo si no hay una entrada vigente; True si la guardó (comprobación atómica)"""
+        with self.lock:
+            entrada = self.entradas.get(clave)
+            if entrada is not None and entrada[0] > time.time():
+                return False
+            self.entradas[clave] = (time.time() + self.ttl, valor)
+            self.entradas.move_to_end(clave)
+            while len(self.entradas) > self.maximo:
+                self.entradas.popitem(last=False)
+            return True
+
+    def expirar(self):
+        """Descarta las entradas vencidas más antiguas (se detiene en la primera vigente)"""
+        eliminadas = 0
+        with self.lock:
+            ahora = time.time()
+            while self.entradas:
+                clave, (expira_en, _) = next(iter(self.entradas.items()))
+                if expira_en > ahora:
+                    break
+                del self.entradas[clave]
+                eliminadas += 1
+        return eliminadas
+
+    def invalidar(self, clave):
+        with self.lock:
+            self.entradas.pop(clave, None)
+            self.generacion += 1
+
+    def estado(self):
+        consultas = self.aciertos + self.fallos
+        return {
+            "entradas": len(self.entradas),
+            "aciertos": self.aciertos,
+            "fallos": self.fallos,
+            "tasa_aciertos": round(self.aciertos / consultas, 3) if consultas else 0,
+        }
+
+cache_faq = CacheTTL(CACHE_RESPUESTAS_MAXIMO, ttl=CACHE_FAQ_TTL_SEGUNDOS)
+
+# --- CACHÉ DE DERECHOS DE ACCESO ---
+# El acceso de un teléfono solo cambia a medianoche, al activar una suscripción o al
+# registrar la sesión del día (ambos invalidan su entrada). Con varios workers la
+# invalidación es local: el tope de TTL acota cuánto tarda otro worker en verla.
+DERECHOS_TTL_SEGUNDOS = int(os.getenv('ALMA_DERECHOS_TTL_SEGUNDOS', 60))
+DERECHOS_MAXIMO = int(os.getenv('ALMA_DERECHOS_MAXIMO', 10000))
+
+# tipo: 'pagado', 'trial' o 'bloqueado'; dias_restantes del acceso vigente
+DerechosAcceso = namedtuple('DerechosAcceso', 'tipo dias_restantes uso_hoy')
+cache_derechos = CacheTTL(DERECHOS_MAXIMO, ttl=DERECHOS_TTL_SEGUNDOS)
+
+def segundos_hasta_medianoche():
+    ahora = datetime.now()
+    manana = datetime(ahora.year, ahora.month, ahora.day) + timedelta(days=1)
+    return (manana - ahora).total_seconds()
+
+def obtener_derechos(user_phone):
+    """Derechos del teléfono; sin parsear fechas ni leer el almacén mientras estén cacheados"""
+    derechos = cache_derechos.obtener(user_phone)
+    if derechos is None:
+        # Si registrar_sesion_diaria o activar_suscripcion invalidan mientras se calcula,
+        # el resultado (posiblemente anterior a su escritura) no se guarda
+        generacion = cache_derechos.generacion
+        derechos = calcular_derechos(user_phone)
+        cache_derechos.guardar(user_phone, derechos, generacion=generacion,
+                               ttl=min(DERECHOS_TTL_SEGUNDOS, segundos_hasta_medianoche()))
+    return derechos
+
+# Preguntas genéricas (normalizadas, sin signos) cuya respuesta no depende del usuario
+PREGUNTAS_FRECUENTES = {
+    "que es mindfulness", "que es el mindfulness", "que es la atencion plena",
+    "que es la meditacion", "como meditar", "como medito", "como empiezo a meditar",
+    "que es alma", "quien eres", "que eres", "que haces", "como funciona", "como funcionas",
+}
+
+def clave_pregunta_frecuente(user_message):
+    """Pregunta normalizada si es una FAQ cacheable (None si no aplica o el caché está apagado)"""
+    if not CACHE_FAQ:
+        return None
+    pregunta = ' '.join(re.sub(r'[^\w\s]', ' ', normalizar_texto(user_message)).split())
+    return pregunta if pregunta in PREGUNTAS_FRECUENTES else None
+
+def construir_prompt_faq(pregunta):
+    """Prompt neutro para una FAQ (sesión nueva, pregunta normalizada): su respuesta sirve para todos"""
+    return construir_prompt_alma(pregunta, SesionUsuario(), None)
 
 def generar_respuesta_suscripcion(user_phone):
     """Genera respuesta personalizada según el estado del usuario"""
-    dias_restantes = dias_restantes_trial(user_phone)
-    tiene_suscripcion = verificar_suscripcion_activa(user_phone)
+    derechos = obtener_derechos(user_phone)
+    dias_restantes = derechos.dias_restantes if derechos.tipo == 'trial' else 0
     
-    if tiene_suscripcion:
-        dias_susc = dias_restantes_suscripcion(user_phone)
+    if derechos.tipo == 'pagado':
+        dias_susc = derechos.dias_restantes
         return f"""
 ✅ **Tu suscripción está activa**
 
@@ -620,125 +2188,62 @@ Actualmente tienes **{dias_restantes} días** de prueba gratuita restantes.
     else:
         return MENSAJE_SUSCRIPCION
 
+@metricas.medido('intencion')
 def manejar_comando_suscripcion(user_phone, user_message, conversation_history):
-    """Sistema unificado de detección de intención comercial"""
-    message_lower = user_message.lower().strip()
+    """Sistema unificado de detección de intención comercial (una sola pasada)"""
+    resultado = INDICE_INTENCION.clasificar(user_message, contexto_comercial_reciente(conversation_history))
     
-    # 1. 🎯 ANÁLISIS SEMÁNTICO INTELIGENTE (detecta "es gratis", "cuanto cuesta", etc.)
-    if analizar_intencion_comercial(user_message, conversation_history):
-        print(f"💰 Intención comercial detectada semánticamente: '{user_message}'")
+    if resultado.etapa == 'semantica':
+        print(f"💰 Intención comercial detectada semánticamente (puntuación {resultado.puntuacion})")
         return generar_respuesta_suscripcion(user_phone)
-    
-    # 2. 📋 TRIGGERS ESPECÍFICOS COMPLETOS
-    triggers_especificos = [
-        # DATOS Y INFORMACIÓN
-        "datos de suscripción", "datos para suscripción", "datos para suscribirse",
-        "datos para suscribirme", "datos de pago", "datos para pago", "datos para pagar",
-        "datos bancarios", "número de cuenta", "clabe interbancaria", "cuenta para pagar",
-        "cuenta de depósito", "datos para transferencia", "datos para depósito",
-        "información de pago", "datos para abonar", "datos para enviar dinero",
-        
-        # SUSCRIPCIÓN Y REGISTRO
-        "cómo suscribirme", "cómo me suscribo", "cómo me doy de alta", "quiero suscribirme",
-        "deseo suscribirme", "quiero registrarme", "quiero darme de alta", "activar mi suscripción",
-        "iniciar suscripción", "empezar mi suscripción", "contratar el servicio", "cómo contratar",
-        "cómo me uno", "cómo acceder al servicio", "cómo obtener acceso",
-        
-        # PAGO Y TRANSACCIONES
-        "cómo pago", "quiero pagar", "deseo pagar", "realizar el pago", "hacer el pago",
-        "pagar ahora", "cómo hacer el pago", "cómo abono", "cómo transferir", "cómo depositar",
-        "cómo hacer la transferencia", "cómo enviar el dinero", "cómo completar el pago",
-        "cómo pagar por transferencia", "cómo pagar por depósito",
-        
-        # PRECIO Y COSTOS
-        "cuánto cuesta", "cuál es el precio", "formas de pago", "métodos de pago", 
-        "opciones de pago", "información de precio", "info de precio",
-        
-        # INFORMACIÓN GENERAL
-        "cómo funciona la suscripción", "qué necesito para suscribirme",
-        "información de pago", "info de pago", "información para pago", "info para pago",
-        "información para pagar", "info para pagar", "información de alta", "info de alta",
-        "información de depósito", "info de depósito", "información para depositar",
-        "info para depositar", "información de suscripción", "info de suscripción",
-        "información para suscripción", "info para suscripción", "información para suscribirse",
-        "info para suscribirse", "información para suscribirme", "info para suscribirme",
-        
-        # RENOVACIÓN Y ACTUALIZACIÓN
-        "cómo renovar mi suscripción", "quiero renovar", "quiero actualizar mi plan",
-        
-        # GRATUIDAD (ahora incluido aquí)
-        "es gratis", "es gratuito", "no tiene costo", "es sin pago", "es free"
-    ]
-    
-    for trigger in triggers_especificos:
-        if trigger in message_lower:
-            print(f"💰 Trigger específico detectado: {trigger}")
-            return generar_respuesta_suscripcion(user_phone)
-    
-    # 3. 💬 DETECCIÓN DE CONVERSACIONES NATURALES
-    conversaciones_naturales = [
-        # PATRONES DE PREGUNTAS SOBRE PRECIO
-        ("cuanto", ["cuesta", "vale", "es", "hay que pagar", "debo pagar"]),
-        ("precio", ["de alma", "del servicio", "mensual", "anual", "tiene"]),
-        ("costo", ["del servicio", "de alma", "mensual", "tiene"]),
-        ("valor", ["del servicio", "de alma", "mensual"]),
-        
-        # PATRONES DE SUSCRIPCIÓN
-        ("suscripción", ["cómo", "como", "quiero", "deseo", "activar", "iniciar"]),
-        ("suscribir", ["me", "cómo", "como", "quiero", "deseo"]),
-        ("suscripcion", ["cómo", "como", "quiero", "deseo", "activar"]),
-        
-        # PATRONES DE PAGO
-        ("pago", ["cómo", "como", "dónde", "donde", "quiero", "deseo", "realizar"]),
-        ("pagar", ["cómo", "como", "dónde", "donde", "quiero", "deseo"]),
-        ("abonar", ["cómo", "como", "dónde", "donde"]),
-        ("transferir", ["cómo", "como", "dónde", "donde"]),
-        ("depositar", ["cómo", "como", "dónde", "donde"]),
-        
-        # PATRONES DE DATOS BANCARIOS
-        ("datos", ["bancarios", "de pago", "para pagar", "cuenta", "transferencia"]),
-        ("cuenta", ["bancaria", "para pagar", "depósito", "transferencia"]),
-        ("clabe", ["interbancaria", "para transferir"]),
-        ("banco", ["para depositar", "para transferir"]),
-        
-        # PATRONES DE INFORMACIÓN
-        ("información", ["de pago", "para pagar", "sobre precios", "suscripción"]),
-        ("info", ["de pago", "para pagar", "sobre precios", "suscripción"]),
-        
-        # PATRONES DE ACCIÓN
-        ("quiero", ["pagar", "comprar", "contratar", "suscribirme", "registrarme"]),
-        ("deseo", ["pagar", "comprar", "contratar", "suscribirme", "registrarme"]),
-        ("necesito", ["pagar", "suscribirme", "información de pago"]),
-        
-        # PATRONES DE MÉTODOS
-        ("método", ["de pago", "para pagar"]),
-        ("metodo", ["de pago", "para pagar"]),
-        ("forma", ["de pago", "para pagar"]),
-        ("opción", ["de pago", "para pagar"]),
-        ("opcion", ["de pago", "para pagar"]),
-        
-        # PATRONES DE RENOVACIÓN
-        ("renovar", ["mi suscripción", "suscripción", "cómo", "como"]),
-        ("actualizar", ["mi plan", "plan", "suscripción"])
-    ]
-    
-    for palabra, combinaciones in conversaciones_naturales:
-        if palabra in message_lower:
-            for combo in combinaciones:
-                if combo in message_lower:
-                    print(f"💬 Conversación natural detectada: '{palabra} {combo}'")
-                    return generar_respuesta_suscripcion(user_phone)
-    
-    # 4. 🛡️ COMPROBANTES - SOLO con confirmación explícita de pago
-    if any(palabra in message_lower for palabra in ["comprobante", "captura"]):
-        if any(confirmacion in message_lower for confirmacion in ["ya pagué", "pagué", "transferí", "deposité"]):
-            print(f"📋 Comprobante CONFIRMADO: {user_message}")
-            return "📋 **Comprobante recibido**\nHemos registrado tu comprobante. Un administrador activará tu suscripción en las próximas 24 horas. ¡Gracias por confiar en Alma! 🌱"
+    if resultado.etapa == 'trigger':
+        print(f"💰 Trigger específico detectado: {resultado.regla}")
+        return generar_respuesta_suscripcion(user_phone)
+    if resultado.etapa == 'natural':
+        print(f"💬 Conversación natural detectada: '{resultado.regla}'")
+        return generar_respuesta_suscripcion(user_phone)
+    if resultado.etapa == 'comprobante':
+        print(f"📋 Comprobante CONFIRMADO de {user_phone}")
+        return MENSAJE_COMPROBANTE_RECIBIDO
     
     return None
 
+# --- PRESUPUESTO DE TOKENS DEL PROMPT ---
+# Tokens (estimados) disponibles para el historial reciente y tope por mensaje del usuario
+PROMPT_PRESUPUESTO_HISTORIAL = int(os.getenv('ALMA_PROMPT_PRESUPUESTO_HISTORIAL', 800))
+PROMPT_MAX_TOKENS_MENSAJE = int(os.getenv('ALMA_PROMPT_MAX_TOKENS_MENSAJE', 1000))
+# Estimación local: ~0.3 tokens por carácter (tokenizador de DeepSeek) + sobrecosto por mensaje
+TOKENS_POR_CARACTER = 0.3
+TOKENS_POR_MENSAJE = 4
+
+def estimar_tokens(texto):
+    return int(len(texto) * TOKENS_POR_CARACTER) + TOKENS_POR_MENSAJE
+
+def recortar_a_tokens(texto, maximo):
+    """Recorta el texto para que su estimación no pase de `maximo` tokens"""
+    if estimar_tokens(texto) <= maximo:
+        return texto
+    caracteres = max(int((maximo - TOKENS_POR_MENSAJE) / TOKENS_POR_CARACTER), 0)
+    return texto[:caracteres].rstrip() + "…"
+
+def historial_en_presupuesto(conversation_history, presupuesto):
+    """Mensajes user/assistant de los turnos más recientes que caben en el presupuesto"""
+    mensajes = []
+    for turno in reversed(conversation_history):
+        user = recortar_a_tokens(turno.user, PROMPT_MAX_TOKENS_MENSAJE)
+        costo = estimar_tokens(user) + estimar_tokens(turno.alma)
+        if costo > presupuesto:
+            break
+        presupuesto -= costo
+        mensajes.append({"role": "assistant", "content": turno.alma})
+        mensajes.append({"role": "user", "content": user})
+    mensajes.reverse()
+    return mensajes
+
+@metricas.medido('prompt')
 def construir_prompt_alma(user_message, user_session, user_phone):
-    tiempo_transcurrido_minutos = int((datetime.now().timestamp() - user_session['session_start_time']) / 60)
+    """Mensajes para DeepSeek: sistema (estático) + historial en presupuesto + turno actual"""
+    tiempo_transcurrido_minutos = int((time.time() - user_session.session_start_time) / 60)
     
     if tiempo_transcurrido_minutos >= LIMITE_SESION_MAXIMO_MINUTOS:
         estatus_sesion = f"LIMITE EXCEDIDO ({LIMITE_SESION_MAXIMO_MINUTOS} MINUTOS). DEBES CERRAR INMEDIATAMENTE."
@@ -749,50 +2254,495 @@ def construir_prompt_alma(user_message, user_session, user_phone):
     else:
         estatus_sesion = f"Sesión en curso. {DURACION_SESION_NORMAL_MINUTOS - tiempo_transcurrido_minutos} minutos restantes."
         
-    conversation_history = ""
-    for msg in user_session['conversation_history'][-3:]:
-        conversation_history += f"Usuario: {msg['user']}\nAlma: {msg['alma']}\n"
-    
-    prompt = ALMA_PROMPT_BASE.format(
+    turno_actual = ALMA_PROMPT_TURNO.format(
         tiempo_transcurrido=tiempo_transcurrido_minutos,
         estatus_sesion=estatus_sesion,
         limite_maximo=LIMITE_SESION_MAXIMO_MINUTOS,
-        conversation_history=conversation_history,
-        user_message=user_message
+        user_message=recortar_a_tokens(user_message, PROMPT_MAX_TOKENS_MENSAJE)
     )
     
     if tiempo_transcurrido_minutos >= DURACION_SESION_NORMAL_MINUTOS:
-        prompt += f"\n\n{AVISO_CIERRE}"
+        turno_actual += f"\n\n{AVISO_CIERRE}"
     
+    mensajes = [MENSAJE_SISTEMA_ALMA]
+    if user_session.resumen:
+        # Después del sistema estático para no romper su prefijo cacheado
+        mensajes.append({"role": "system", "content": PROMPT_RESUMEN_SESION.format(resumen=user_session.resumen)})
+    return (mensajes
+            + historial_en_presupuesto(user_session.turnos_sin_resumir(), PROMPT_PRESUPUESTO_HISTORIAL)
+            + [{"role": "user", "content": turno_actual}])
+
+# --- CLIENTE HTTP DE DEEPSEEK (POOL KEEP-ALIVE + REINTENTOS) ---
+DEEPSEEK_TIMEOUT_CONEXION = float(os.getenv('DEEPSEEK_TIMEOUT_CONEXION', 5))
+DEEPSEEK_TIMEOUT_LECTURA = float(os.getenv('DEEPSEEK_TIMEOUT_LECTURA', 30))
+DEEPSEEK_REINTENTOS = int(os.getenv('DEEPSEEK_REINTENTOS', 2))
+DEEPSEEK_BACKOFF_BASE_SEGUNDOS = 0.5
+DEEPSEEK_BACKOFF_MAXIMO_SEGUNDOS = 8
+
+latencias_deepseek = {
+    'handshake': metricas.histograma('alma_deepseek_segundos', fase='handshake'),   # TCP + TLS de conexiones nuevas
+    'generacion': metricas.histograma('alma_deepseek_segundos', fase='generacion'),  # Petición sin el handshake
+    'total': metricas.histograma('alma_deepseek_segundos', fase='total'),
+    'primer_fragmento': metricas.histograma('alma_deepseek_segundos', fase='primer_fragmento')  # Solo en modo streaming
+}
+medicion_local = local()
+
+class ConexionHTTPMedida(HTTPConnection):
+    def connect(self):
+        inicio = time.perf_counter()
+        super().connect()
+        duracion = time.perf_counter() - inicio
+        medicion_local.handshake = getattr(medicion_local, 'handshake', 0.0) + duracion
+        latencias_deepseek['handshake'].observar(duracion)
+
+class ConexionHTTPSMedida(HTTPSConnection):
+    def connect(self):
+        inicio = time.perf_counter()
+        super().connect()
+        duracion = time.perf_counter() - inicio
+        medicion_local.handshake = getattr(medicion_local, 'handshake', 0.0) + duracion
+        latencias_deepseek['handshake'].observar(duracion)
+
+class PoolHTTPMedido(HTTPConnectionPool):
+    ConnectionCls = ConexionHTTPMedida
+
+class PoolHTTPSMedido(HTTPSConnectionPool):
+    ConnectionCls = ConexionHTTPSMedida
+
+class AdaptadorMedido(HTTPAdapter):
+    """HTTPAdapter cuyas conexiones registran el tiempo de handshake"""
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': PoolHTTPMedido,
+            'https': PoolHTTPSMedido
+        }
+
+sesion_deepseek = None
+sesion_deepseek_lock = Lock()
+
+def obtener_sesion_deepseek():
+    """Session compartida con pool keep-alive del tamaño del pool de workers"""
+    global sesion_deepseek
+    with sesion_deepseek_lock:
+        if sesion_deepseek is None:
+            sesion = requests.Session()
+            adaptador = AdaptadorMedido(pool_connections=1, pool_maxsize=PIPELINE_WORKERS)
+            sesion.mount('https://', adaptador)
+            sesion.mount('http://', adaptador)
+            sesion.headers.update({
+                "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
+                "Content-Type": "application/json"
+            })
+            sesion_deepseek = sesion
+        return sesion_deepseek
+
+def backoff_con_jitter(intento, base=DEEPSEEK_BACKOFF_BASE_SEGUNDOS,
+                       maximo=DEEPSEEK_BACKOFF_MAXIMO_SEGUNDOS):
+    """Backoff exponencial con jitter completo"""
+    return random.uniform(0, min(maximo, base * 2 ** intento))
+
+def espera_reintento(intento, response=None):
+    """Backoff para DeepSeek; respeta Retry-After en 429"""
+    if response is not None and response.headers.get('Retry-After', '').isdigit():
+        return min(float(response.headers['Retry-After']), DEEPSEEK_BACKOFF_MAXIMO_SEGUNDOS)
+    return backoff_con_jitter(intento)
+
+def post_deepseek(data, stream=False, espera_ranura=None):
+    """POST a DeepSeek con timeouts separados y reintentos en 429/5xx y fallos de conexión.
+
+    Cada intento ocupa un lugar de limitador_deepseek (no las pausas entre reintentos);
+    lanza DeepSeekSaturado si no hay lugar en `espera_ranura` segundos. Con stream=True y
+    respuesta 200 el lugar sigue ocupado: lo libera quien termina de leer el stream.
+    """
+    sesion = obtener_sesion_deepseek()
+    if espera_ranura is None:
+        espera_ranura = DEEPSEEK_ESPERA_RANURA_SEGUNDOS
+    for intento in range(DEEPSEEK_REINTENTOS + 1):
+        ultimo = intento == DEEPSEEK_REINTENTOS
+        if not limitador_deepseek.adquirir(espera_ranura):
+            raise DeepSeekSaturado()
+        medicion_local.handshake = 0.0
+        inicio = time.perf_counter()
+        try:
+            response = sesion.post(
+                DEEPSEEK_URL, json=data, stream=stream,
+                timeout=(DEEPSEEK_TIMEOUT_CONEXION, DEEPSEEK_TIMEOUT_LECTURA)
+            )
+        except requests.exceptions.ConnectionError as e:
+            # Incluye ConnectTimeout; un ReadTimeout no se reintenta (ya esperamos de más)
+            limitador_deepseek.liberar()
+            limitador_deepseek.observar(time.perf_counter() - inicio, sobrecarga=True)
+            if ultimo:
+                raise
+            print(f"⚠️ DeepSeek sin conexión (intento {intento + 1}): {e}")
+            time.sleep(espera_reintento(intento))
+            continue
+        except BaseException as e:
+            limitador_deepseek.liberar()
+            if isinstance(e, requests.exceptions.Timeout):
+                limitador_deepseek.observar(time.perf_counter() - inicio, sobrecarga=True)
+            raise
+
+        duracion = time.perf_counter() - inicio
+        latencias_deepseek['total'].observar(duracion)
+        latencias_deepseek['generacion'].observar(max(0.0, duracion - medicion_local.handshake))
+
+        # En streaming `duracion` llega hasta los encabezados: el largo de la respuesta no cuenta
+        limitador_deepseek.observar(
+            duracion, sobrecarga=response.status_code == 429 or response.status_code >= 500)
+        if not (stream and response.status_code == 200):
+            limitador_deepseek.liberar()
+        if (response.status_code == 429 or response.status_code >= 500) and not ultimo:
+            print(f"⚠️ DeepSeek respondió {response.status_code} (intento {intento + 1}), reintentando")
+            espera = espera_reintento(intento, response)
+            response.close()
+            time.sleep(espera)
+            continue
+        return response
+
+# --- CONTROL DE ADMISIÓN ---
+# Cubeta de tokens por teléfono (frena a quien inunda el webhook) y límite adaptativo
+# de llamadas simultáneas a DeepSeek (AIMD: crece de a poco mientras DeepSeek responde
+# a tiempo y se reduce en proporción ante 429/5xx o latencia alta). Ambos son por
+# proceso: con N workers el total permitido es N veces el configurado.
+ADMISION_MENSAJES_POR_MINUTO = float(os.getenv('ALMA_ADMISION_MENSAJES_POR_MINUTO', 6))
+ADMISION_RAFAGA = int(os.getenv('ALMA_ADMISION_RAFAGA', 5))
+ADMISION_TELEFONOS_MAXIMO = int(os.getenv('ALMA_ADMISION_TELEFONOS_MAXIMO', 10000))
+DEEPSEEK_CONCURRENCIA_MINIMA = int(os.getenv('ALMA_DEEPSEEK_CONCURRENCIA_MINIMA', 2))
+DEEPSEEK_CONCURRENCIA_MAXIMA = int(os.getenv('ALMA_DEEPSEEK_CONCURRENCIA_MAXIMA', 32))
+DEEPSEEK_LATENCIA_OBJETIVO_SEGUNDOS = float(os.getenv('ALMA_DEEPSEEK_LATENCIA_OBJETIVO_SEGUNDOS', 15))
+# Cuánto espera un mensaje por una llamada libre antes de recibir la respuesta de saturación
+DEEPSEEK_ESPERA_RANURA_SEGUNDOS = float(os.getenv('ALMA_DEEPSEEK_ESPERA_RANURA_SEGUNDOS', 10))
+
+MENSAJE_LIMITE_MENSAJES = "Recibí muchos mensajes tuyos en poco tiempo. Dame un momento para leerte con calma y escríbeme de nuevo en un minuto. 🌱"
+MENSAJE_ALMA_SATURADA = "En este momento estoy acompañando a muchas personas. Escríbeme de nuevo en unos minutos y con gusto te escucho. 🌱"
+
+class AdmisionPorTelefono:
+    """Cubeta de tokens por teléfono (LRU acotado; un teléfono olvidado vuelve con la cubeta llena)"""
+
+    def __init__(self, por_minuto, rafaga, maximo):
+        self.por_segundo = por_minuto / 60.0
+        self.rafaga = rafaga
+        self.maximo = maximo
+        self.cubetas = OrderedDict()  # teléfono -> [tokens, última recarga, avisado]
+        self.rechazados = 0
+        self.lock = Lock()
+
+    def admitir(self, user_phone):
+        """(admitido, avisar): avisar solo en el primer rechazo hasta que la cubeta se recupere"""
+        if self.por_segundo <= 0:
+            return True, False
+        with self.lock:
+            ahora = time.monotonic()
+            cubeta = self.cubetas.get(user_phone)
+            if cubeta is None:
+                cubeta = self.cubetas[user_phone] = [float(self.rafaga), ahora, False]
+                while len(self.cubetas) > self.maximo:
+                    self.cubetas.popitem(last=False)
+            else:
+                self.cubetas.move_to_end(user_phone)
+                cubeta[0] = min(self.rafaga, cubeta[0] + (ahora - cubeta[1]) * self.por_segundo)
+                cubeta[1] = ahora
+            if cubeta[0] >= 1:
+                cubeta[0] -= 1
+                cubeta[2] = False
+                return True, False
+            self.rechazados += 1
+            avisar = not cubeta[2]
+            cubeta[2] = True
+            return False, avisar
+
+    def estado(self):
+        return {"telefonos": len(self.cubetas), "rechazados": self.rechazados,
+                "mensajes_por_minuto": ADMISION_MENSAJES_POR_MINUTO, "rafaga": self.rafaga}
+
+class LimitadorConcurrenciaAdaptativo:
+    """Límite AIMD de llamadas simultáneas: +1/límite por llamada sana, ×factor ante sobrecarga"""
+
+    def __init__(self, minimo, maximo, latencia_objetivo, factor=0.7):
+        self.minimo = minimo
+        self.maximo = maximo
+        self.latencia_objetivo = latencia_objetivo
+        self.factor = factor
+        self.limite = float(max(minimo, maximo // 2))
+        self.en_vuelo = 0
+        self.diferidos = 0
+        self.reducciones = 0
+        self.ultima_reduccion = 0.0
+        self.condicion = Condition()
+
+    def adquirir(self, espera=0):
+        """True si obtuvo lugar dentro de `espera` segundos"""
+        limite_espera = time.monotonic() + espera
+        with self.condicion:
+            while self.en_vuelo >= int(self.limite):
+                restante = limite_espera - time.monotonic()
+                if restante <= 0:
+                    self.diferidos += 1
+                    return False
+                self.condicion.wait(restante)
+            self.en_vuelo += 1
+        return True
+
+    def liberar(self):
+        with self.condicion:
+            self.en_vuelo -= 1
+            self.condicion.notify()
+
+    def observar(self, latencia, sobrecarga=False):
+        """Ajusta el límite con la latencia de un intercambio HTTP con DeepSeek"""
+        ahora = time.monotonic()
+        with self.condicion:
+            if sobrecarga or latencia > self.latencia_objetivo:
+                # Una reducción por ventana: las llamadas lentas que ya estaban en vuelo
+                # reflejan la misma congestión y no deben desplomar el límite
+                if ahora - self.ultima_reduccion > self.latencia_objetivo:
+                    self.limite = max(self.minimo, self.limite * self.factor)
+                    self.ultima_reduccion = ahora
+                    self.reducciones += 1
+            else:
+                self.limite = min(self.maximo, self.limite + 1 / self.limite)
+                self.condicion.notify()
+
+    def estado(self):
+        return {"limite": int(self.limite), "en_vuelo": self.en_vuelo,
+                "diferidos": self.diferidos, "reducciones": self.reducciones}
+
+admision_telefonos = AdmisionPorTelefono(
+    ADMISION_MENSAJES_POR_MINUTO, ADMISION_RAFAGA, ADMISION_TELEFONOS_MAXIMO)
+limitador_deepseek = LimitadorConcurrenciaAdaptativo(
+    DEEPSEEK_CONCURRENCIA_MINIMA, DEEPSEEK_CONCURRENCIA_MAXIMA, DEEPSEEK_LATENCIA_OBJETIVO_SEGUNDOS)
+
+class DeepSeekSaturado(Exception):
+    """No hubo lugar en limitador_deepseek dentro de la espera permitida"""
+
+# Respuestas cuando DeepSeek falla (nunca se guardan en caché)
+RESPALDO_DEEPSEEK_ERROR = "Entiendo que quieres conectar. Estoy aquí para escucharte. ¿Puedes contarme más sobre cómo te sientes? 🌱"
+RESPALDO_DEEPSEEK_EXCEPCION = "Veo que estás buscando apoyo. ¿Podrías contarme más sobre lo que necesitas en este momento? 💫"
+
+def mensajes_deepseek(prompt):
+    """Acepta una lista de mensajes (role/content) o un prompt suelto como mensaje de usuario"""
+    if isinstance(prompt, str):
+        return [{"role": "user", "content": prompt}]
     return prompt
 
+@metricas.medido('deepseek')
 def llamar_deepseek(prompt):
     try:
-        headers = {
-            "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
-            "Content-Type": "application/json"
-        }
         data = {
             "model": "deepseek-chat",
-            "messages": [{"role": "user", "content": prompt}],
+            "messages": mensajes_deepseek(prompt),
             "temperature": 0.7,
             "max_tokens": 600,
             "stream": False
         }
         
-        print(f"🔍 DEBUG: Llamando a DeepSeek API...")
-        response = requests.post(DEEPSEEK_URL, headers=headers, json=data, timeout=30)
-        print(f"🔍 DEBUG: Status Code: {response.status_code}")
+        response = post_deepseek(data)
         
         if response.status_code == 200:
             return response.json()['choices'][0]['message']['content'].strip()
         else:
-            print(f"Error DeepSeek API: {response.status_code} - {response.text}")
-            return "Entiendo que quieres conectar. Estoy aquí para escucharte. ¿Puedes contarme más sobre cómo te sientes? 🌱"
+            print(f"Error DeepSeek API: {response.status_code} - {response.text[:200]}")
+            metricas.contar('alma_deepseek_errores_total', tipo='http')
+            return RESPALDO_DEEPSEEK_ERROR
             
+    except DeepSeekSaturado:
+        raise
     except Exception as e:
         print(f"Excepción en llamar_deepseek: {str(e)}")
-        return "Veo que estás buscando apoyo. ¿Podrías contarme más sobre lo que necesitas en este momento? 💫"
+        metricas.contar('alma_deepseek_errores_total', tipo='excepcion')
+        return RESPALDO_DEEPSEEK_EXCEPCION
+
+# --- RESPUESTAS EN STREAMING (ENTREGA POR PÁRRAFOS) ---
+DEEPSEEK_STREAMING = os.getenv('DEEPSEEK_STREAMING', '0') == '1'
+# Un párrafo más corto que esto se junta con el siguiente antes de enviarse
+STREAMING_MIN_CARACTERES = int(os.getenv('ALMA_STREAMING_MIN_CARACTERES', 120))
+
+def extraer_fragmentos(buffer, minimo=None):
+    """Separa del buffer los párrafos completos (terminados en línea en blanco).
+
+    Devuelve (fragmento_listo o None, resto_del_buffer).
+    """
+    if minimo is None:
+        minimo = STREAMING_MIN_CARACTERES
+    corte = buffer.rfind("\n\n")
+    if corte < max(minimo, 1):
+        return None, buffer
+    return buffer[:corte].strip(), buffer[corte + 2:]
+
+@metricas.medido('deepseek')
+def llamar_deepseek_streaming(prompt, entregar_fragmento):
+    """Consume el stream SSE de DeepSeek y entrega cada párrafo en cuanto se completa.
+
+    entregar_fragmento(texto) se llama una vez por fragmento. Devuelve la
+    respuesta completa para guardarla en el historial.
+    """
+    fallback = RESPALDO_DEEPSEEK_EXCEPCION
+    enviado = []
+    saturado = False
+    # Los fragmentos salen por Twilio desde otro hilo, en orden: la lectura del stream
+    # (y el lugar ocupado en limitador_deepseek) no espera a los envíos
+    fragmentos = Queue()
+
+    def repartir():
+        while True:
+            fragmento = fragmentos.get()
+            if fragmento is None:
+                return
+            entregar_fragmento(fragmento)
+    repartidor = Thread(target=repartir, daemon=True, name='alma-fragmentos')
+    repartidor.start()
+    try:
+        data = {
+            "model": "deepseek-chat",
+            "messages": mensajes_deepseek(prompt),
+            "temperature": 0.7,
+            "max_tokens": 600,
+            "stream": True
+        }
+        inicio = time.perf_counter()
+        response = post_deepseek(data, stream=True)
+        if response.status_code != 200:
+            print(f"Error DeepSeek API (stream): {response.status_code} - {response.text[:200]}")
+            metricas.contar('alma_deepseek_errores_total', tipo='http')
+            return fallback
+        
+        response.encoding = 'utf-8'
+        buffer = ""
+        try:
+            with response:
+                for linea in response.iter_lines(decode_unicode=True):
+                    if not linea or not linea.startswith('data:'):
+                        continue
+                    payload = linea[5:].strip()
+                    if payload == '[DONE]':
+                        break
+                    delta = json.loads(payload)['choices'][0].get('delta', {})
+                    buffer += delta.get('content') or ''
+                    
+                    fragmento, buffer = extraer_fragmentos(buffer)
+                    if fragmento:
+                        if not enviado:
+                            latencias_deepseek['primer_fragmento'].observar(time.perf_counter() - inicio)
+                        fragmentos.put(fragmento)
+                        enviado.append(fragmento)
+        finally:
+            limitador_deepseek.liberar()
+        
+        if buffer.strip():
+            if not enviado:
+                latencias_deepseek['primer_fragmento'].observar(time.perf_counter() - inicio)
+            fragmentos.put(buffer.strip())
+            enviado.append(buffer.strip())
+        
+    except DeepSeekSaturado:
+        saturado = True
+        raise
+    except Exception as e:
+        print(f"Excepción en llamar_deepseek_streaming: {str(e)}")
+        metricas.contar('alma_deepseek_errores_total', tipo='excepcion')
+    finally:
+        if not enviado and not saturado:
+            fragmentos.put(fallback)
+        fragmentos.put(None)
+        repartidor.join()
+    
+    if not enviado:
+        return fallback
+    return "\n\n".join(enviado)
+
+# --- RESUMEN INCREMENTAL DE LA CONVERSACIÓN ---
+# Cada RESUMEN_CADA_TURNOS turnos, los más antiguos (salvo los RESUMEN_TURNOS_RECIENTES
+# últimos) se condensan en session.resumen fuera del camino de la respuesta.
+# Normalmente el disparo ocurre antes de que el deque del historial los descarte;
+# si un resumen falla o se omite (DeepSeek saturado), los turnos que el deque ya
+# descartó quedan fuera del resumen y el siguiente parte del primero que conserva.
+RESUMEN_CADA_TURNOS = int(os.getenv('ALMA_RESUMEN_CADA_TURNOS', 8))
+RESUMEN_TURNOS_RECIENTES = int(os.getenv('ALMA_RESUMEN_TURNOS_RECIENTES', 2))
+RESUMEN_MAX_TOKENS = int(os.getenv('ALMA_RESUMEN_MAX_TOKENS', 250))
+
+PROMPT_RESUMIR = """Actualiza el resumen de una sesión de apoyo emocional entre un usuario y Alma.
+Conserva lo importante para continuar la conversación: cómo se siente el usuario, temas y
+situaciones que mencionó, cómo pidió que le hablaran (p. ej. si dijo ser mujer), técnicas
+practicadas y acuerdos. Máximo 120 palabras, en tercera persona. Responde solo con el resumen.
+
+RESUMEN ANTERIOR:
+{resumen}
+
+TURNOS NUEVOS:
+{turnos}"""
+
+cola_resumenes = None
+resumenes_en_curso = set()
+resumenes_lock = Lock()
+
+def generar_resumen(resumen_previo, turnos):
+    """Pide el resumen a DeepSeek; None si falla (no se guarda un texto de respaldo)"""
+    texto_turnos = "\n".join(f"Usuario: {t.user}\nAlma: {t.alma}" for t in turnos)
+    data = {
+        "model": "deepseek-chat",
+        "messages": [{"role": "user", "content": PROMPT_RESUMIR.format(
+            resumen=resumen_previo or "(sin resumen todavía)", turnos=texto_turnos)}],
+        "temperature": 0.3,
+        "max_tokens": RESUMEN_MAX_TOKENS,
+        "stream": False
+    }
+    try:
+        # Sin lugar libre no se espera: el próximo turno lo volverá a intentar
+        response = post_deepseek(data, espera_ranura=0)
+        if response.status_code != 200:
+            print(f"⚠️ Resumen no generado: DeepSeek {response.status_code}")
+            return None
+        return response.json()['choices'][0]['message']['content'].strip() or None
+    except DeepSeekSaturado:
+        return None
+    except Exception as e:
+        print(f"⚠️ Resumen no generado: {e}")
+        return None
+
+def resumir_sesion(user_phone, inicio_sesion, base, hasta, resumen_previo, turnos):
+    try:
+        resumen = generar_resumen(resumen_previo, turnos)
+        if resumen is None:
+            return
+
+        def aplicar(session):
+            # Se descarta si la sesión se cerró o reinició, o si alguien ya avanzó el resumen;
+            # los turnos agregados mientras tanto se conservan (se modifica la sesión vigente)
+            if (session is None or session.session_start_time != inicio_sesion
+                    or session.resumidos_hasta != base or session.turnos_totales < hasta):
+                return None
+            session.resumen = resumen
+            session.resumidos_hasta = hasta
+            return session
+        almacen_sesiones.actualizar(user_phone, aplicar)
+    finally:
+        with resumenes_lock:
+            resumenes_en_curso.discard(user_phone)
+
+def programar_resumen(user_phone, session):
+    """Encola el resumen si ya se acumularon RESUMEN_CADA_TURNOS turnos sin resumir"""
+    global cola_resumenes
+    if not RESUMEN_CADA_TURNOS:
+        return
+    if session.turnos_totales - session.resumidos_hasta < RESUMEN_CADA_TURNOS:
+        return
+    pendientes = session.turnos_sin_resumir()
+    a_resumir = pendientes[:max(len(pendientes) - RESUMEN_TURNOS_RECIENTES, 0)]
+    if not a_resumir:
+        return
+    with resumenes_lock:
+        if user_phone in resumenes_en_curso:
+            return
+        resumenes_en_curso.add(user_phone)
+        if cola_resumenes is None:
+            cola_resumenes = ThreadPoolExecutor(max_workers=2, thread_name_prefix='alma-resumen')
+    base = session.resumidos_hasta
+    # Índice absoluto del primer turno a resumir: el deque pudo descartar turnos posteriores a base
+    inicio = max(base, session.turnos_totales - len(session.conversation_history))
+    cola_resumenes.submit(resumir_sesion, user_phone, session.session_start_time, base,
+                          inicio + len(a_resumir), session.resumen, a_resumir)
 
 def enviar_respuesta_crisis(telefono):
     MENSAJE_CRISIS = """
@@ -817,49 +2767,291 @@ Te espero en este tu espacio cuando te sientas mejor o quieras seguir hablando.
     return enviar_respuesta_twilio(MENSAJE_CRISIS, telefono)
 
 # ✅ LIMPIEZA MEJORADA - AHORA SOLO LIMPIA MEMORIA TEMPORAL
-def ejecutar_limpieza_automatica():
+def limpiar_sesiones():
     """Limpia solo sesiones en memoria, datos críticos están en JSON"""
-    def tarea_limpieza():
+    # Expira solo las sesiones inactivas más allá del TTL (índice ordenado por last_contact)
+    sesiones_limpiadas = almacen_sesiones.expirar()
+    
+    if sesiones_limpiadas > 0:
+        print(f"🧹 Sesiones en memoria limpiadas: {sesiones_limpiadas}")
+        print(f"📊 Estado actual - Sesiones en memoria: {almacen_sesiones.contar()}")
+    mensajes_vistos.expirar()
+
+# --- DEDUPLICACIÓN DE REINTENTOS DE TWILIO ---
+# Si el webhook tarda más que el timeout de Twilio, Twilio reenvía el mismo MessageSid.
+# Se recuerda cada MessageSid durante un TTL y los repetidos se descartan antes de
+# cualquier trabajo (sin otra llamada a DeepSeek, respuesta ni turno duplicados).
+MENSAJES_VISTOS_TTL_SEGUNDOS = int(os.getenv('ALMA_MENSAJES_VISTOS_TTL_SEGUNDOS', 3600))
+MENSAJES_VISTOS_MAXIMO = int(os.getenv('ALMA_MENSAJES_VISTOS_MAXIMO', 50000))
+
+class MensajesVistos(ABC):
+    """Interfaz del registro de MessageSid recibidos"""
+
+    @abstractmethod
+    def registrar(self, message_sid):
+        """True si el mensaje es nuevo; False si ya se recibió dentro del TTL"""
+
+    @abstractmethod
+    def expirar(self):
+        ...
+
+    @abstractmethod
+    def estado(self):
+        ...
+
+class MensajesVistosMemoria(MensajesVistos):
+    """MessageSid vistos por este proceso (LRU acotado con TTL)"""
+
+    def __init__(self):
+        self.cache = CacheTTL(MENSAJES_VISTOS_MAXIMO, ttl=MENSAJES_VISTOS_TTL_SEGUNDOS)
+        self.duplicados = 0
+
+    def registrar(self, message_sid):
+        if self.cache.guardar_si_ausente(message_sid):
+            return True
+        self.duplicados += 1
+        return False
+
+    def expirar(self):
+        return self.cache.expirar()
+
+    def estado(self):
+        return {"almacen": "memoria", "entradas": len(self.cache.entradas),
+                "duplicados": self.duplicados}
+
+class MensajesVistosSQLite(BaseDatosSQLite, MensajesVistos):
+    """MessageSid vistos por todos los workers (mismo archivo que las sesiones compartidas)"""
+
+    def __init__(self, ruta):
+        super().__init__(ruta)
+        self.duplicados = 0
+        with self.transaccion() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS mensajes_vistos "
+                         "(sid TEXT PRIMARY KEY, expira_en REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_mensajes_vistos_expira "
+                         "ON mensajes_vistos (expira_en)")
+
+    def registrar(self, message_sid):
+        ahora = time.time()
+        with self.transaccion() as conn:
+            conn.execute("DELETE FROM mensajes_vistos WHERE sid = ? AND expira_en <= ?",
+                         (message_sid, ahora))
+            nuevo = conn.execute(
+                "INSERT OR IGNORE INTO mensajes_vistos (sid, expira_en) VALUES (?, ?)",
+                (message_sid, ahora + MENSAJES_VISTOS_TTL_SEGUNDOS)).rowcount == 1
+        if not nuevo:
+            self.duplicados += 1
+        return nuevo
+
+    def expirar(self):
+        with self.transaccion() as conn:
+            return conn.execute("DELETE FROM mensajes_vistos WHERE expira_en <= ?",
+                                (time.time(),)).rowcount
+
+    def estado(self):
+        # duplicados es por proceso; el total entre workers está en /metrics
+        return {"almacen": "sqlite", "duplicados": self.duplicados}
+
+def crear_mensajes_vistos():
+    # Con sesiones compartidas un reintento puede llegar a otro worker
+    if SESSION_STORE == 'sqlite':
+        return MensajesVistosSQLite(SESSION_STORE_FILE)
+    return MensajesVistosMemoria()
+
+mensajes_vistos = crear_mensajes_vistos()
+
+# --- PIPELINE ASÍNCRONO DE MENSAJES ---
+# El webhook solo valida y encola; un pool acotado de hilos hace el trabajo
+# lento (verificación de acceso, DeepSeek y envío por Twilio).
+WEBHOOK_ASINCRONO = os.getenv('ALMA_WEBHOOK_ASINCRONO', '1') == '1'
+PIPELINE_WORKERS = int(os.getenv('ALMA_PIPELINE_WORKERS', 16))
+PIPELINE_CAPACIDAD = int(os.getenv('ALMA_PIPELINE_CAPACIDAD', 500))
+# Mensajes seguidos del mismo teléfono dentro de esta ventana se responden en un solo turno
+DEBOUNCE_SEGUNDOS = float(os.getenv('ALMA_DEBOUNCE_SEGUNDOS', 2.0))
+DEBOUNCE_MAXIMO_SEGUNDOS = float(os.getenv('ALMA_DEBOUNCE_MAXIMO_SEGUNDOS', 6.0))
+
+class BuzonUsuario:
+    """Mensajes pendientes de un teléfono; solo un worker lo procesa a la vez"""
+    __slots__ = ('mensajes', 'primer_arribo', 'ultimo_arribo', 'programado', 'en_proceso')
+
+    def __init__(self):
+        self.mensajes = []
+        self.primer_arribo = 0.0
+        self.ultimo_arribo = 0.0
+        self.programado = False
+        self.en_proceso = False
+
+class PipelineMensajes:
+    """Buzón ordenado por teléfono + pool de hilos que procesan fuera del request HTTP.
+
+    Los mensajes de un mismo teléfono se procesan estrictamente en orden y los
+    que llegan dentro de la ventana de debounce se agrupan en un solo turno.
+    """
+    def __init__(self, workers, capacidad):
+        self.workers = workers
+        self.capacidad = capacidad
+        self.listos = Queue()           # Teléfonos listos para procesar
+        self.buzones = {}               # phone -> BuzonUsuario
+        self.agenda = []                # Heap (listo_en, phone) de buzones en debounce
+        self.condicion = Condition()
+        self.iniciado = False
+        self.pendientes = 0
+        self.en_proceso = 0
+        self.encolados = 0
+        self.procesados = 0
+        self.turnos = 0
+        self.rechazados = 0
+        self.errores = 0
+
+    def iniciar(self):
+        """Arranca los hilos en el primer mensaje (ya dentro del worker de gunicorn)"""
+        with self.condicion:
+            if self.iniciado:
+                return
+            self.iniciado = True
+        Thread(target=self.despachar, name="alma-despachador", daemon=True).start()
+        for i in range(self.workers):
+            Thread(target=self.trabajar, name=f"alma-pipeline-{i}", daemon=True).start()
+        print(f"✅ Pipeline asíncrono INICIADO ({self.workers} workers)")
+
+    def encolar(self, user_phone, user_message):
+        """Encola sin bloquear; devuelve False si hay demasiados pendientes (backpressure)"""
+        self.iniciar()
+        ahora = time.monotonic()
+        with self.condicion:
+            if self.pendientes >= self.capacidad:
+                self.rechazados += 1
+                print(f"⚠️ Cola llena ({self.capacidad}), mensaje rechazado de {user_phone}")
+                return False
+            buzon = self.buzones.get(user_phone)
+            if buzon is None:
+                buzon = self.buzones[user_phone] = BuzonUsuario()
+            buzon.mensajes.append(user_message)
+            buzon.ultimo_arribo = ahora
+            self.pendientes += 1
+            self.encolados += 1
+            if not buzon.programado and not buzon.en_proceso:
+                self.programar(user_phone, buzon, ahora)
+        return True
+
+    def programar(self, user_phone, buzon, ahora):
+        """Agenda el buzón para después del debounce (requiere self.condicion)"""
+        buzon.programado = True
+        buzon.primer_arribo = ahora
+        heapq.heappush(self.agenda, (buzon.ultimo_arribo + DEBOUNCE_SEGUNDOS, user_phone))
+        self.condicion.notify()
+
+    def despachar(self):
+        """Pasa a la cola de listos los buzones cuyo debounce terminó"""
+        while True:
+            with self.condicion:
+                while not self.agenda:
+                    self.condicion.wait()
+                listo_en, user_phone = self.agenda[0]
+                ahora = time.monotonic()
+                if listo_en > ahora:
+                    self.condicion.wait(listo_en - ahora)
+                    continue
+                heapq.heappop(self.agenda)
+                buzon = self.buzones[user_phone]
+                # Ventana deslizante: esperar a que el usuario deje de escribir, con tope
+                limite = min(buzon.ultimo_arribo + DEBOUNCE_SEGUNDOS,
+                             buzon.primer_arribo + DEBOUNCE_MAXIMO_SEGUNDOS)
+                if limite > ahora:
+                    heapq.heappush(self.agenda, (limite, user_phone))
+                    continue
+            self.listos.put(user_phone)
+
+    def trabajar(self):
         while True:
+            user_phone = self.listos.get()
+            with self.condicion:
+                buzon = self.buzones[user_phone]
+                mensajes, buzon.mensajes = buzon.mensajes, []
+                buzon.programado = False
+                buzon.en_proceso = True
+                self.pendientes -= len(mensajes)
+                self.en_proceso += 1
             try:
-                print("🧹 Ejecutando limpieza de memoria...")
-                hoy = datetime.now()
-                
-                # Limpiar solo sesiones en memoria > 7 días
-                sesiones_limpiadas = 0
-                for phone in list(user_sessions.keys()):
-                    session = user_sessions[phone]
-                    last_contact = datetime.fromisoformat(session['last_contact'])
-                    if (hoy - last_contact).days > 7:
-                        user_sessions.pop(phone, None)
-                        sesiones_limpiadas += 1
-                
-                if sesiones_limpiadas > 0:
-                    print(f"🧹 Sesiones en memoria limpiadas: {sesiones_limpiadas}")
-                
-                print(f"📊 Estado actual - Sesiones en memoria: {len(user_sessions)}")
-                
-                time.sleep(86400 * 7)  # Cada 7 días
-                
+                procesar_mensaje(user_phone, "\n".join(mensajes))
+                with self.condicion:
+                    self.procesados += len(mensajes)
+                    self.turnos += 1
             except Exception as e:
-                print(f"❌ Error en limpieza: {e}")
-                time.sleep(3600)
-    
-    thread = Thread(target=tarea_limpieza, daemon=True)
-    thread.start()
-    print("✅ Sistema de limpieza de memoria INICIADO")
+                print(f"❌ Error en pipeline: {e}")
+                with self.condicion:
+                    self.errores += 1
+            finally:
+                with self.condicion:
+                    self.en_proceso -= 1
+                    buzon.en_proceso = False
+                    if buzon.mensajes:
+                        # Llegaron más mensajes mientras se procesaba: siguiente turno
+                        self.programar(user_phone, buzon, time.monotonic())
+                    else:
+                        del self.buzones[user_phone]
+
+    def estado(self):
+        with self.condicion:
+            return {
+                "asincrono": WEBHOOK_ASINCRONO,
+                "workers": self.workers,
+                "capacidad": self.capacidad,
+                "pendientes": self.pendientes,
+                "buzones_activos": len(self.buzones),
+                "en_proceso": self.en_proceso,
+                "encolados": self.encolados,
+                "procesados": self.procesados,
+                "turnos": self.turnos,
+                "coalescidos": self.procesados - self.turnos,
+                "rechazados": self.rechazados,
+                "errores": self.errores
+            }
+
+pipeline = PipelineMensajes(PIPELINE_WORKERS, PIPELINE_CAPACIDAD)
 
 # --- ENDPOINT PRINCIPAL ACTUALIZADO ---
 @app.route('/webhook', methods=['POST'])
 def webhook():
+    user_phone = request.form.get('From', '')
+    user_message = request.form.get('Body', '').strip()
+    
+    if not user_phone or not user_message:
+        return Response("OK", status=200)
+    
+    # Reintento de Twilio de un mensaje ya recibido: no repetir nada
+    message_sid = request.form.get('MessageSid')
+    if message_sid and not mensajes_vistos.registrar(message_sid):
+        metricas.contar('alma_webhook_duplicados_total')
+        return Response("OK", status=200)
+    metricas.contar('alma_mensajes_recibidos_total')
+    
+    # Cubeta de tokens por teléfono; un mensaje de crisis nunca se frena
+    admitido, avisar = admision_telefonos.admitir(user_phone)
+    if not admitido and not buscar_crisis(user_message):
+        metricas.contar('alma_admision_rechazados_total', motivo='telefono')
+        if avisar:
+            return respuesta_twiml(MENSAJE_LIMITE_MENSAJES)
+        return Response("OK", status=200)
+    
+    if not WEBHOOK_ASINCRONO:
+        procesar_mensaje(user_phone, user_message)
+        return Response("OK", status=200)
+    
+    # Responder a Twilio de inmediato; la respuesta de Alma sale por la API REST
+    if not pipeline.encolar(user_phone, user_message):
+        # Twilio no reintenta un webhook de mensajería ante un 5xx: se acepta el
+        # mensaje y se avisa al usuario en la misma respuesta (una crisis nunca se pospone)
+        if buscar_crisis(user_message):
+            return enviar_respuesta_crisis(user_phone)
+        return respuesta_twiml(MENSAJE_ALMA_SATURADA)
+    return Response("OK", status=200)
+
+def procesar_mensaje(user_phone, user_message):
+    """Procesa un mensaje entrante completo y envía la respuesta por Twilio"""
     try:
-        user_phone = request.form.get('From', '')
-        user_message = request.form.get('Body', '').strip()
-        
-        if not user_message:
-            return Response("OK", status=200)
-        
-        print(f"🔔 MENSAJE RECIBIDO de {user_phone}: {user_message}")
+        # Sin el contenido del mensaje: los logs no deben guardar conversaciones
+        print(f"🔔 MENSAJE RECIBIDO de {user_phone} ({len(user_message)} caracteres)")
         
         # 1. VERIFICAR ACCESO
         if not usuario_puede_chatear(user_phone):
@@ -872,19 +3064,25 @@ def webhook():
         respuesta_suscripcion = manejar_comando_suscripcion(
             user_phone, 
             user_message, 
-            session['conversation_history']
+            session.conversation_history
         )
         if respuesta_suscripcion:
             return enviar_respuesta_twilio(respuesta_suscripcion, user_phone)
         
         # 4. VERIFICAR LÍMITE DIARIO PERSISTENTE
-        if usuario_ya_uso_sesion_hoy(user_phone):
+        # Al empezar una sesión se lee del almacén: otro worker pudo registrar la del día
+        # y el caché de este proceso no se enteró
+        if session.conversation_history:
+            uso_hoy = obtener_derechos(user_phone).uso_hoy
+        else:
+            uso_hoy = usuario_ya_uso_sesion_hoy(user_phone)
+        if uso_hoy:
             tiempo_restante = obtener_proximo_reset()
             mensaje_bloqueo = f"¡Hola! Ya disfrutaste tu sesión de Alma de hoy. Podrás iniciar tu próxima sesión en {tiempo_restante}. ¡Estaré aquí para ti! 🌱"
             return enviar_respuesta_twilio(mensaje_bloqueo, user_phone)
 
         # 5. MOSTRAR PRIVACIDAD SOLO AL INICIO DE CONVERSACIÓN
-        if len(session['conversation_history']) == 0:
+        if len(session.conversation_history) == 0:
             enviar_respuesta_twilio(MENSAJE_PRIVACIDAD, user_phone)
 
         # 6. VERIFICAR LÍMITE DE TIEMPO POR SESIÓN
@@ -892,23 +3090,24 @@ def webhook():
         if restriccion is not True:
             # Registrar que completó sesión hoy
             registrar_sesion_diaria(user_phone)
-            user_sessions.pop(user_phone, None)
+            almacen_sesiones.eliminar(user_phone)
             return enviar_respuesta_twilio(restriccion['mensaje'], user_phone)
         
         # 7. PROTOCOLO DE CRISIS PRECISO
         if detectar_crisis_real(user_message):
-            session['crisis_count'] += 1
+            metricas.contar('alma_crisis_detectadas_total')
+            session.crisis_count += 1
             save_user_session(user_phone, session)
             return enviar_respuesta_crisis(user_phone)
 
         # 8. GESTIÓN DE TIEMPO: LÍMITE FORZADO
-        tiempo_transcurrido_minutos = int((datetime.now().timestamp() - session['session_start_time']) / 60)
+        tiempo_transcurrido_minutos = int((time.time() - session.session_start_time) / 60)
         
         if tiempo_transcurrido_minutos >= LIMITE_SESION_MAXIMO_MINUTOS:
             # REGISTRAR SESIÓN COMPLETADA
             registrar_sesion_diaria(user_phone)
             alma_response = f"Gracias por tu tiempo. Hemos alcanzado el límite máximo de {LIMITE_SESION_MAXIMO_MINUTOS} minutos por hoy. Tu progreso está guardado. ¡Podrás iniciar tu próxima sesión mañana! 🌱"
-            user_sessions.pop(user_phone, None)
+            almacen_sesiones.eliminar(user_phone)
             return enviar_respuesta_twilio(alma_response, user_phone)
         
         # 9. RECORDATORIO SUAVE DE CIERRE (menos invasivo)
@@ -921,66 +3120,179 @@ def webhook():
             user_message = AVISO_CIERRE + " ||| " + user_message
 
         # 10. GENERAR RESPUESTA CON ALMA (personalidad femenina mejorada)
-        prompt = construir_prompt_alma(user_message, session, user_phone)
-        alma_response = llamar_deepseek(prompt)
-        print(f"💬 RESPUESTA DE ALMA: {alma_response}")
+        # Una FAQ al inicio de la conversación puede salir del caché sin llamar a DeepSeek
+        clave_faq = clave_pregunta_frecuente(user_message) if not session.conversation_history else None
+        alma_response = cache_faq.obtener(clave_faq) if clave_faq else None
+        en_streaming = False
+        if alma_response is None:
+            # Una FAQ se genera sin datos del usuario porque su respuesta se comparte
+            if clave_faq:
+                mensajes = construir_prompt_faq(clave_faq)
+            else:
+                mensajes = construir_prompt_alma(user_message, session, user_phone)
+            try:
+                if DEEPSEEK_STREAMING:
+                    # Cada párrafo sale por Twilio en cuanto DeepSeek lo termina
+                    en_streaming = True
+                    alma_response = llamar_deepseek_streaming(
+                        mensajes, lambda fragmento: enviar_respuesta_twilio(fragmento, user_phone))
+                else:
+                    alma_response = llamar_deepseek(mensajes)
+            except DeepSeekSaturado:
+                # Sin lugar para otra llamada a DeepSeek: respuesta fija, sin guardar el turno
+                metricas.contar('alma_admision_rechazados_total', motivo='deepseek')
+                return enviar_respuesta_twilio(MENSAJE_ALMA_SATURADA, user_phone)
+            if clave_faq and alma_response not in (RESPALDO_DEEPSEEK_ERROR, RESPALDO_DEEPSEEK_EXCEPCION):
+                cache_faq.guardar(clave_faq, alma_response)
         
         # 11. GUARDAR HISTORIAL EN MEMORIA
-        session['conversation_history'].append({
-            'user': user_message,
-            'alma': alma_response,
-            'timestamp': datetime.now().isoformat()
-        })
-        
-        if len(session['conversation_history']) > 10:
-            session['conversation_history'] = session['conversation_history'][-10:]
-            
+        # (el deque descarta solo los turnos más antiguos)
+        session.agregar_turno(user_message, alma_response, INDICE_INTENCION.es_comercial(user_message))
         save_user_session(user_phone, session)
+        programar_resumen(user_phone, session)
         
-        # 12. ENVIAR RESPUESTA
+        # 12. ENVIAR RESPUESTA (en streaming ya se envió por fragmentos)
+        if en_streaming:
+            return Response("OK", status=200)
         return enviar_respuesta_twilio(alma_response, user_phone)
         
     except Exception as e:
-        print(f"❌ ERROR CRÍTICO en webhook: {str(e)}")
+        print(f"❌ ERROR CRÍTICO procesando mensaje: {str(e)}")
         import traceback
         traceback.print_exc()
         return enviar_respuesta_twilio("Lo siento, estoy teniendo dificultades técnicas. ¿Podrías intentarlo de nuevo? 🌱", user_phone)
 
 # --- ENDPOINTS TWILIO Y ADMIN ---
 
-def enviar_respuesta_twilio(mensaje, telefono):
-    from twilio.rest import Client
+# --- CLIENTE TWILIO COMPARTIDO Y COLA DE ENVÍO ---
+TWILIO_ENVIOS_CONCURRENTES = int(os.getenv('TWILIO_ENVIOS_CONCURRENTES', 8))
+TWILIO_REINTENTOS = int(os.getenv('TWILIO_REINTENTOS', 3))
+# Ritmo máximo de los envíos en lote (recordatorios); las respuestas no se frenan
+TWILIO_LOTE_POR_SEGUNDO = float(os.getenv('TWILIO_LOTE_POR_SEGUNDO', 20))
+# Envíos en lote simultáneos, aparte de los de respuestas: un lote nunca los acapara
+TWILIO_LOTE_CONCURRENTES = int(os.getenv('TWILIO_LOTE_CONCURRENTES', max(1, TWILIO_ENVIOS_CONCURRENTES // 4)))
+TWILIO_TIMEOUT_SEGUNDOS = 15
+
+cliente_twilio = None
+cliente_twilio_lock = Lock()
+# Limitan los envíos simultáneos a Twilio: respuestas y lotes de recordatorios por separado
+semaforo_twilio = BoundedSemaphore(TWILIO_ENVIOS_CONCURRENTES)
+semaforo_lote_twilio = BoundedSemaphore(TWILIO_LOTE_CONCURRENTES)
+# Cola de envíos en lote; se crea al primer uso (ya dentro del worker)
+cola_envios_twilio = None
+
+class LimitadorTasa:
+    """Espacia las llamadas a un máximo de `por_segundo` (compartido entre hilos)"""
+
+    def __init__(self, por_segundo):
+        self.intervalo = 1.0 / por_segundo if por_segundo > 0 else 0
+        self.siguiente = 0.0
+        self.lock = Lock()
+
+    def esperar(self):
+        with self.lock:
+            ahora = time.monotonic()
+            turno = max(ahora, self.siguiente)
+            self.siguiente = turno + self.intervalo
+        if turno > ahora:
+            time.sleep(turno - ahora)
+
+limitador_lote_twilio = LimitadorTasa(TWILIO_LOTE_POR_SEGUNDO)
+
+def obtener_cliente_twilio():
+    """Client de Twilio de larga vida con pool HTTP keep-alive (None sin credenciales)"""
+    global cliente_twilio
+    with cliente_twilio_lock:
+        if cliente_twilio is None:
+            account_sid = os.getenv('TWILIO_ACCOUNT_SID')
+            auth_token = os.getenv('TWILIO_AUTH_TOKEN')
+            if not account_sid or not auth_token:
+                return None
+
+            from twilio.rest import Client
+            from twilio.http.http_client import TwilioHttpClient
+
+            http_client = TwilioHttpClient(pool_connections=True, timeout=TWILIO_TIMEOUT_SEGUNDOS)
+            http_client.session.mount('https://', HTTPAdapter(pool_maxsize=TWILIO_ENVIOS_CONCURRENTES))
+            cliente_twilio = Client(account_sid, auth_token, http_client=http_client)
+        return cliente_twilio
+
+@metricas.medido('twilio')
+def enviar_mensaje_twilio(mensaje, telefono, semaforo=None):
+    """Envía un mensaje con reintentos ante rate limit (429) y errores 5xx.
+
+    semaforo: el de los envíos en lote para recordatorios (por defecto, el de respuestas).
+    Devuelve el SID del mensaje o None si no se pudo enviar.
+    """
     from twilio.base.exceptions import TwilioRestException
-    
-    account_sid = os.getenv('TWILIO_ACCOUNT_SID')
-    auth_token = os.getenv('TWILIO_AUTH_TOKEN')
-    
-    if not account_sid or not auth_token:
+
+    client = obtener_cliente_twilio()
+    if client is None:
         print("Error: Twilio credentials no configuradas")
-        return Response("OK", status=200)
-    
-    client = Client(account_sid, auth_token)
-    try:
-        message = client.messages.create(
-            body=mensaje,
-            from_=TWILIO_WHATSAPP_NUMBER,
-            to=telefono
-        )
-        print(f"✅ Mensaje Twilio enviado: {message.sid}")
-        return Response("OK", status=200)
-    except TwilioRestException as e:
-        print(f"❌ ERROR Twilio: {e.code} - {e.msg}")
-        return Response("OK", status=200)
-    except Exception as e:
-        print(f"❌ Error general al enviar mensaje: {e}")
-        return Response("OK", status=200)
+        metricas.contar('alma_twilio_envios_total', resultado='error')
+        return None
+
+    for intento in range(TWILIO_REINTENTOS + 1):
+        try:
+            with semaforo or semaforo_twilio:
+                message = client.messages.create(
+                    body=mensaje,
+                    from_=TWILIO_WHATSAPP_NUMBER,
+                    to=telefono
+                )
+            print(f"✅ Mensaje Twilio enviado: {message.sid}")
+            metricas.contar('alma_twilio_envios_total', resultado='ok')
+            return message.sid
+        except TwilioRestException as e:
+            reintentable = e.status == 429 or e.code == 20429 or e.status >= 500
+            if not reintentable or intento == TWILIO_REINTENTOS:
+                print(f"❌ ERROR Twilio: {e.code} - {e.msg}")
+                metricas.contar('alma_twilio_envios_total', resultado='error')
+                return None
+            print(f"⚠️ Twilio {e.status} (intento {intento + 1}), reintentando")
+            metricas.contar('alma_twilio_reintentos_total')
+            time.sleep(backoff_con_jitter(intento))
+        except Exception as e:
+            print(f"❌ Error general al enviar mensaje: {e}")
+            metricas.contar('alma_twilio_envios_total', resultado='error')
+            return None
+
+def enviar_respuesta_twilio(mensaje, telefono):
+    enviar_mensaje_twilio(mensaje, telefono)
+    return Response("OK", status=200)
+
+def respuesta_twiml(mensaje):
+    """Respuesta en el cuerpo del webhook: no ocupa el hilo con la API REST ni sus reintentos"""
+    from twilio.twiml.messaging_response import MessagingResponse
+
+    twiml = MessagingResponse()
+    twiml.message(mensaje)
+    return Response(str(twiml), status=200, mimetype='application/xml')
+
+def enviar_mensaje_lote(mensaje, telefono):
+    limitador_lote_twilio.esperar()
+    return enviar_mensaje_twilio(mensaje, telefono, semaforo_lote_twilio)
+
+def enviar_lote_twilio(envios):
+    """Envía en paralelo (acotado y a ritmo limitado) una lista de (telefono, mensaje).
+
+    Devuelve {telefono: sid o None} cuando terminan todos los envíos.
+    """
+    global cola_envios_twilio
+    with cliente_twilio_lock:
+        if cola_envios_twilio is None:
+            cola_envios_twilio = ThreadPoolExecutor(
+                max_workers=TWILIO_LOTE_CONCURRENTES, thread_name_prefix='alma-twilio')
+    futuros = {
+        telefono: cola_envios_twilio.submit(enviar_mensaje_lote, mensaje, telefono)
+        for telefono, mensaje in envios
+    }
+    return {telefono: futuro.result() for telefono, futuro in futuros.items()}
 
 @app.route('/admin/activar/<user_phone>', methods=['POST'])
 def admin_activar_suscripcion(user_phone):
     try:
-        activar_suscripcion(user_phone)
-        subs = cargar_suscripciones_persistentes()
-        sub = subs[user_phone]
+        sub = activar_suscripcion(user_phone)
         
         mensaje = MENSAJE_SUSCRIPCION_ACTIVA.format(
             fecha_vencimiento=datetime.strptime(sub['fecha_vencimiento'], '%Y-%m-%d').strftime('%d/%m/%Y')
@@ -998,38 +3310,219 @@ def admin_activar_suscripcion(user_phone):
 @app.route('/admin/estado', methods=['GET'])
 def admin_estado():
     """Endpoint de administración para ver estado del sistema"""
-    sesiones = cargar_sesiones_persistentes()
-    trials = cargar_trials_persistentes()
-    subs = cargar_suscripciones_persistentes()
-    
     return {
         "status": "healthy",
         "service": "Alma Chatbot - Sistema Persistente",
-        "sesiones_diarias": len(sesiones),
-        "usuarios_trial": len(trials),
-        "suscripciones_activas": sum(1 for s in subs.values() if s['estado'] == 'activo'),
-        "sessions_memoria": len(user_sessions),
+        "backend": BACKEND_ALMACENAMIENTO,
+        "sesiones_diarias": contadores_agregados.total(COLECCION_SESIONES),
+        "usuarios_trial": contadores_agregados.total(COLECCION_TRIALS),
+        "suscripciones_activas": contadores_agregados.total(COLECCION_SUSCRIPCIONES, 'activo'),
+        "suscripciones_vencidas": contadores_agregados.total(COLECCION_SUSCRIPCIONES, 'vencido'),
+        "sessions_memoria": contadores_agregados.sesiones_en_memoria(),
+        "contadores": contadores_agregados.estado(),
+        "session_store": SESSION_STORE,
+        "pipeline": pipeline.estado(),
+        "mensajes_vistos": mensajes_vistos.estado(),
+        "admision": {
+            "telefonos": admision_telefonos.estado(),
+            "deepseek": limitador_deepseek.estado(),
+        },
+        "recordatorios": programador_recordatorios.estado(),
+        "cache_respuestas": {
+            "derechos": cache_derechos.estado(),
+            # Cada acierto de FAQ es una llamada a DeepSeek evitada
+            "faq": dict(cache_faq.estado(), activo=CACHE_FAQ, llamadas_deepseek_evitadas=cache_faq.aciertos),
+        },
+        "tareas_fondo": ejecutor_tareas.estado(),
+        "deepseek": {nombre: h.resumen() for nombre, h in latencias_deepseek.items()},
         "timestamp": datetime.now().isoformat()
     }
 
 @app.route('/health', methods=['GET'])
 def health_check():
-    sesiones = cargar_sesiones_persistentes()
-    subs = cargar_suscripciones_persistentes()
-    
     return {
         "status": "healthy", 
         "service": "Alma Chatbot - Sistema Persistente",
-        "users_activos": len(user_sessions),
-        "suscripciones_activas": sum(1 for s in subs.values() if s['estado'] == 'activo'),
-        "usuarios_persistentes": len(sesiones),
+        "users_activos": contadores_agregados.sesiones_en_memoria(),
+        "suscripciones_activas": contadores_agregados.total(COLECCION_SUSCRIPCIONES, 'activo'),
+        "usuarios_persistentes": contadores_agregados.total(COLECCION_SESIONES),
+        "cola_pendiente": pipeline.pendientes,
+        # Encolados + turnos que un worker ya tomó pero aún no terminó de responder
+        "trabajo_pendiente": pipeline.pendientes + pipeline.en_proceso,
         "timestamp": datetime.now().isoformat()
     }
 
+metricas.indicador('alma_deepseek_limite_concurrencia', lambda: int(limitador_deepseek.limite),
+                   'Llamadas simultáneas a DeepSeek permitidas (límite adaptativo)')
+metricas.indicador('alma_deepseek_en_vuelo', lambda: limitador_deepseek.en_vuelo,
+                   'Llamadas a DeepSeek en curso')
+metricas.indicador('alma_cola_pendiente', lambda: pipeline.pendientes,
+                   'Mensajes encolados que ningún worker tomó todavía')
+metricas.indicador('alma_pipeline_en_proceso', lambda: pipeline.en_proceso,
+                   'Turnos que un worker del pipeline está procesando')
+metricas.indicador('alma_pipeline_rechazados_total', lambda: pipeline.rechazados,
+                   'Mensajes rechazados por cola llena (respondidos con el aviso de saturación)', tipo='counter')
+metricas.indicador('alma_pipeline_procesados_total', lambda: pipeline.procesados,
+                   'Mensajes procesados por el pipeline', tipo='counter')
+metricas.indicador('alma_sesiones_memoria', lambda: contadores_agregados.sesiones_en_memoria(),
+                   'Sesiones de conversación retenidas')
+metricas.indicador('alma_suscripciones_activas',
+                   lambda: contadores_agregados.total(COLECCION_SUSCRIPCIONES, 'activo'),
+                   'Suscripciones pagadas en estado activo')
+metricas.indicador('alma_usuarios_trial', lambda: contadores_agregados.total(COLECCION_TRIALS),
+                   'Usuarios que iniciaron un trial')
+metricas.indicador('alma_recordatorios_programados', lambda: len(programador_recordatorios.heap),
+                   'Recordatorios de vencimiento pendientes en el heap')
+metricas.indicador('alma_cache_faq_aciertos_total', lambda: cache_faq.aciertos,
+                   'Respuestas FAQ servidas sin llamar a DeepSeek', tipo='counter')
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Métricas del proceso en formato de texto de Prometheus"""
+    return Response(metricas.exportar(), mimetype='text/plain; version=0.0.4')
+
+# --- TAREAS EN SEGUNDO PLANO ---
+# Se inician desde el hook post_worker_init de gunicorn (gunicorn.conf.py) o desde __main__.
+# Las tareas compartidas (recordatorios, compactación) solo corren en el worker líder,
+# elegido con un flock sobre ALMA_LIDER_LOCK; el SO libera el lock si el líder muere.
+LIDER_LOCK_FILE = os.getenv('ALMA_LIDER_LOCK', 'alma_lider.lock')
+LIDER_REINTENTO_SEGUNDOS = 30
+
+class EleccionLider:
+    """Un solo proceso de la máquina retiene el flock del archivo de liderazgo"""
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self.fd = None
+        self.lock = Lock()
+
+    def es_lider(self):
+        """Intenta (sin bloquear) tomar el liderazgo; una vez líder, lo es hasta terminar"""
+        with self.lock:
+            if self.fd is not None:
+                return True
+            if fcntl is None:
+                # Sin flock no hay varios workers que coordinar
+                self.fd = -1
+                return True
+            fd = os.open(self.ruta, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                return False
+            os.ftruncate(fd, 0)
+            os.write(fd, str(os.getpid()).encode())
+            self.fd = fd
+            print(f"👑 Worker {os.getpid()} elegido líder de tareas en segundo plano")
+            return True
+
+class TareaFondo:
+    """Ejecuta `paso` en bucle en su propio hilo y registra estado y duración de cada pasada.
+
+    `paso` devuelve los segundos hasta la próxima pasada (o None para usar `intervalo`);
+    `esperar` permite que la tarea duerma con su propio mecanismo (p. ej. una Condition).
+    """
+
+    def __init__(self, nombre, paso, intervalo, solo_lider=False, esperar=None):
+        self.nombre = nombre
+        self.paso = paso
+        self.intervalo = intervalo
+        self.solo_lider = solo_lider
+        self.esperar = esperar or time.sleep
+        self.estado_actual = 'detenida'
+        self.ejecuciones = 0
+        self.errores = 0
+        self.ultima_ejecucion = None
+        self.ultima_duracion = None
+        self.ultimo_error = None
+
+    def bucle(self, eleccion):
+        while True:
+            if self.solo_lider and not eleccion.es_lider():
+                self.estado_actual = 'seguidor'
+                time.sleep(LIDER_REINTENTO_SEGUNDOS)
+                continue
+            self.estado_actual = 'ejecutando'
+            inicio = time.perf_counter()
+            espera = None
+            try:
+                espera = self.paso()
+            except Exception as e:
+                self.errores += 1
+                self.ultimo_error = str(e)
+                print(f"❌ Error en tarea {self.nombre}: {e}")
+                espera = 300  # Reintentar en 5 minutos
+            self.ejecuciones += 1
+            self.ultima_ejecucion = datetime.now().isoformat()
+            self.ultima_duracion = round(time.perf_counter() - inicio, 3)
+            self.estado_actual = 'esperando'
+            self.esperar(self.intervalo if espera is None else espera)
+
+    def estado(self):
+        return {
+            "estado": self.estado_actual,
+            "solo_lider": self.solo_lider,
+            "ejecuciones": self.ejecuciones,
+            "errores": self.errores,
+            "ultima_ejecucion": self.ultima_ejecucion,
+            "ultima_duracion_segundos": self.ultima_duracion,
+            "ultimo_error": self.ultimo_error,
+        }
+
+class EjecutorTareas:
+    def __init__(self, eleccion):
+        self.eleccion = eleccion
+        self.tareas = []
+        self.iniciado = False
+        self.lock = Lock()
+
+    def registrar(self, tarea):
+        self.tareas.append(tarea)
+        return tarea
+
+    def iniciar(self):
+        """Arranca un hilo por tarea (una sola vez por proceso, ya dentro del worker)"""
+        with self.lock:
+            if self.iniciado:
+                return
+            self.iniciado = True
+        for tarea in self.tareas:
+            Thread(target=tarea.bucle, args=(self.eleccion,), daemon=True,
+                   name=f'alma-{tarea.nombre}').start()
+        print(f"✅ Tareas en segundo plano INICIADAS (pid {os.getpid()})")
+
+    def estado(self):
+        return {
+            "lider": self.eleccion.fd is not None,
+            "pid": os.getpid(),
+            "tareas": {tarea.nombre: tarea.estado() for tarea in self.tareas},
+        }
+
+ejecutor_tareas = EjecutorTareas(EleccionLider(LIDER_LOCK_FILE))
+ejecutor_tareas.registrar(TareaFondo(
+    'recordatorios', programador_recordatorios.ciclo, RECORDATORIOS_SINCRONIZAR_SEGUNDOS,
+    solo_lider=True, esperar=programador_recordatorios.esperar))
+# Con sesiones en memoria cada worker limpia las suyas; con SQLite basta el líder
+ejecutor_tareas.registrar(TareaFondo(
+    'limpieza_sesiones', limpiar_sesiones, LIMPIEZA_INTERVALO_SEGUNDOS,
+    solo_lider=SESSION_STORE == 'sqlite'))
+# Cada worker reconcilia sus propios contadores (ven las escrituras de los demás)
+ejecutor_tareas.registrar(TareaFondo(
+    'reconciliacion_contadores', contadores_agregados.reconciliar, CONTADORES_RECONCILIAR_SEGUNDOS))
+if MODO_ALMACENAMIENTO == 'journal':
+    ejecutor_tareas.registrar(TareaFondo(
+        'compactacion_journal', compactar_journals, INTERVALO_COMPACTACION_SEGUNDOS, solo_lider=True))
+
+def iniciar_tareas_fondo():
+    # Primer recuento antes de atender peticiones: /health nunca recorre el almacén
+    if not contadores_agregados.inicializado:
+        contadores_agregados.reconciliar()
+    ejecutor_tareas.iniciar()
+
 if __name__ == '__main__':
     # Iniciar sistemas automáticos
-    ejecutar_recordatorios_automaticos()
-    ejecutar_limpieza_automatica()
+    iniciar_tareas_fondo()
     
     print("🤖 Alma Chatbot INICIADO - SISTEMA 100% PERSISTENTE")
     print(f"📞 Número comprobantes: {NUMERO_COMPROBANTES}")
@@ -0,0 +1,630 @@
+"""
+Benchmarks y pruebas de estrés de Alma (no requieren DeepSeek ni Twilio).
+
+Uso:
+    python benchmark.py estres-persistencia --procesos 8 --escrituras 200
+    python benchmark.py estres-persistencia --backend sqlite
+    python benchmark.py crisis --iteraciones 20000
+    python benchmark.py intencion --iteraciones 20000
+    python benchmark.py memoria-sesiones --turnos 3
+    python benchmark.py carga --usuarios 50 --mensajes 5 --latencia-deepseek 0.3
+    python benchmark.py carga --asincrono --streaming --error-deepseek 0.05
+"""
+import argparse
+import contextlib
+import json
+import logging
+import multiprocessing
+import os
+import random
+import re
+import string
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+RAIZ = os.path.dirname(os.path.abspath(__file__))
+
+
+def importar_app(directorio, entorno):
+    """Importa app.py con los archivos persistentes dentro de `directorio`"""
+    os.environ.update(entorno)
+    os.chdir(directorio)
+    if RAIZ not in sys.path:
+        sys.path.insert(0, RAIZ)
+    import app
+    return app
+
+
+# --- ESTRÉS DE PERSISTENCIA MULTI-PROCESO ---
+
+
+def worker_escritor(directorio, entorno, indice, escrituras):
+    app = importar_app(directorio, entorno)
+    for i in range(escrituras):
+        # Un registro compartido por todos (contención) y uno propio por escritura
+        app.registrar_sesion_diaria('whatsapp:+compartido')
+        app.registrar_sesion_diaria(f'whatsapp:+{indice}-{i}')
+        app.get_user_subscription(f'whatsapp:+{indice}-{i}')
+
+
+def worker_verificador(directorio, entorno, cola):
+    app = importar_app(directorio, entorno)
+    compartido = app.almacen.obtener(app.COLECCION_SESIONES, 'whatsapp:+compartido')
+    cola.put((
+        compartido['session_count'] if compartido else 0,
+        app.almacen.contar(app.COLECCION_SESIONES),
+        app.almacen.contar(app.COLECCION_TRIALS),
+    ))
+
+
+def estres_persistencia(args):
+    directorio = tempfile.mkdtemp(prefix='alma-estres-')
+    entorno = {
+        'ALMA_STORAGE_BACKEND': args.backend,
+        'ALMA_STORAGE_MODE': args.modo,
+    }
+    ctx = multiprocessing.get_context('spawn')
+
+    inicio = time.perf_counter()
+    procesos = [
+        ctx.Process(target=worker_escritor, args=(directorio, entorno, i, args.escrituras))
+        for i in range(args.procesos)
+    ]
+    for p in procesos:
+        p.start()
+    for p in procesos:
+        p.join()
+    duracion = time.perf_counter() - inicio
+
+    cola = ctx.Queue()
+    verificador = ctx.Process(target=worker_verificador, args=(directorio, entorno, cola))
+    verificador.start()
+    compartido, sesiones, trials = cola.get(timeout=60)
+    verificador.join()
+
+    esperado_compartido = args.procesos * args.escrituras
+    esperado_registros = args.procesos * args.escrituras
+    total_escrituras = args.procesos * args.escrituras * 3
+
+    print(f"📁 Directorio: {directorio}")
+    print(f"⚙️  Backend: {args.backend} | Modo: {args.modo} | "
+          f"{args.procesos} procesos x {args.escrituras} iteraciones")
+    print(f"⏱️  {total_escrituras} escrituras en {duracion:.2f}s "
+          f"({total_escrituras / duracion:.0f} escrituras/s)")
+    print(f"🔢 session_count compartido: {compartido} (esperado {esperado_compartido})")
+    print(f"🔢 Sesiones diarias: {sesiones} (esperado {esperado_registros + 1})")
+    print(f"🔢 Trials: {trials} (esperado {esperado_registros})")
+
+    ok = (compartido == esperado_compartido
+          and sesiones == esperado_registros + 1
+          and trials == esperado_registros)
+    print("✅ Sin pérdida de datos" if ok else "❌ Se perdieron escrituras")
+    return 0 if ok else 1
+
+
+# --- DETECCIÓN DE CRISIS: CORPUS DE REGRESIÓN Y MICRO-BENCHMARK ---
+
+# (mensaje, debe_detectarse). Agregar aquí cada frase nueva que aprueben los clínicos.
+CORPUS_CRISIS = [
+    ("quiero suicidarme", True),
+    ("Ya no puedo más, QUIERO SUICIDARME", True),
+    ("me voy a suicidar esta noche", True),
+    ("estoy pensando en suicidarme", True),
+    ("he estado pensando en suicidio", True),
+    ("planeo suicidarme", True),
+    ("me quiero suicidar", True),
+    ("quiero matarme", True),
+    ("me voy a matar", True),
+    ("voy a quitarme la vida", True),
+    ("me voy a quitar la vída", True),
+    ("quiero acabar con mi vida", True),
+    ("pienso saltar de un edificio", True),
+    ("voy a tirarme de un puente", True),
+    ("quiero ahorcarme", True),
+    ("quiero colgarme", True),
+    ("voy a dispararme", True),
+    ("quiero darme un tiro", True),
+    ("voy a cortarme las venas", True),
+    ("quiero   cortar  mis venas", True),
+    ("Quiero\nmatarme", True),
+    ("estoy muy triste hoy", False),
+    ("me muero de risa", False),
+    ("este trabajo me está matando", False),
+    ("quiero acabar con este proyecto", False),
+    ("me siento fatal, no sé qué hacer", False),
+    ("hoy medité 10 minutos", False),
+    ("matarte de risa", False),
+    ("", False),
+]
+
+
+def detectar_crisis_original(user_message, patrones, triggers):
+    """Implementación anterior (regex por patrón + recorrido de triggers) como referencia"""
+    mensaje = user_message.lower().strip()
+    for patron in patrones:
+        if re.search(patron, mensaje):
+            return True
+    return any(trigger in mensaje for trigger in triggers)
+
+
+def medir(funcion, mensajes, iteraciones):
+    inicio = time.perf_counter()
+    for i in range(iteraciones):
+        funcion(mensajes[i % len(mensajes)])
+    return (time.perf_counter() - inicio) / iteraciones * 1e6  # µs por mensaje
+
+
+def frases_sinteticas(cantidad, semilla=7):
+    rnd = random.Random(semilla)
+    return [
+        ' '.join(''.join(rnd.choice(string.ascii_lowercase) for _ in range(rnd.randint(3, 9)))
+                 for _ in range(rnd.randint(2, 4)))
+        for _ in range(cantidad)
+    ]
+
+
+def benchmark_crisis(args):
+    app = importar_app(tempfile.mkdtemp(prefix='alma-bench-'), {})
+
+    fallos = [(m, esperado) for m, esperado in CORPUS_CRISIS
+              if bool(app.buscar_crisis(m)) != esperado]
+    for mensaje, esperado in fallos:
+        print(f"❌ Regresión: {mensaje!r} debería {'detectarse' if esperado else 'NO detectarse'}")
+    print(f"📋 Corpus de regresión: {len(CORPUS_CRISIS) - len(fallos)}/{len(CORPUS_CRISIS)} correctos")
+
+    patrones = [re.escape(f) for f in app.FRASES_CRISIS_EXPLICITAS] + \
+               [re.escape(f) + r"\b" for f in app.FRASES_CRISIS_PALABRA_COMPLETA]
+    mensajes = [m for m, _ in CORPUS_CRISIS if m] + [
+        "Hoy me siento un poco ansioso por el trabajo y no he dormido bien, "
+        "¿me puedes ayudar con una meditación corta para calmarme antes de dormir?"
+    ]
+
+    print(f"\n⏱️  µs por mensaje ({args.iteraciones} iteraciones)")
+    print(f"{'frases':>8} {'original':>10} {'compilado':>10}")
+    for extra in (0, 100, 1000, 5000):
+        sinteticas = frases_sinteticas(extra)
+        triggers = app.TRIGGER_CRISIS + sinteticas
+        detector = app.compilar_detector_crisis(
+            app.FRASES_CRISIS_EXPLICITAS + triggers, app.FRASES_CRISIS_PALABRA_COMPLETA)
+        original = medir(lambda m: detectar_crisis_original(m, patrones, triggers),
+                         mensajes, args.iteraciones)
+        compilado = medir(lambda m: app.buscar_crisis(m, detector), mensajes, args.iteraciones)
+        total = len(patrones) + len(triggers)
+        print(f"{total:>8} {original:>10.2f} {compilado:>10.2f}")
+
+    return 1 if fallos else 0
+
+
+# --- ÍNDICE DE INTENCIÓN COMERCIAL ---
+
+# (mensaje, etapa esperada de IndiceIntencion.clasificar)
+CORPUS_INTENCION = [
+    ("cuánto cuesta la suscripción", 'semantica'),
+    ("quiero los datos bancarios", 'semantica'),
+    ("¿cuánto cuesta?", 'trigger'),
+    ("es gratis?", 'trigger'),
+    ("me pasas la clabe interbancaria", 'trigger'),
+    ("quiero suscribirme", 'trigger'),
+    ("cómo me uno", 'trigger'),
+    ("cual es el valor del servicio", 'natural'),
+    ("ya pagué, te mando captura", 'comprobante'),
+    ("hoy me siento ansioso", None),
+    ("gracias por escucharme", None),
+]
+
+
+def clasificar_lineal(indice, user_message, contexto_comercial=False):
+    """Recorridos lineales como en la versión anterior (referencia para el benchmark)"""
+    message_lower = user_message.lower().strip()
+    puntuacion = sum(peso for palabra, peso in indice.pesos.items() if palabra in message_lower)
+    if contexto_comercial:
+        puntuacion += 2
+    if puntuacion > 0 and message_lower.startswith(('cuanto', 'cuánto', 'cómo', 'como', 'dónde',
+                                                     'donde', 'qué', 'que')):
+        puntuacion += 2
+    if puntuacion >= 4:
+        return 'semantica'
+    for trigger in indice.prioridad_trigger:
+        if trigger in message_lower:
+            return 'trigger'
+    for palabra, combos in indice.naturales:
+        if palabra in message_lower:
+            for combo in combos:
+                if combo in message_lower:
+                    return 'natural'
+    if (any(p in message_lower for p in indice.comprobantes)
+            and any(c in message_lower for c in indice.confirmaciones)):
+        return 'comprobante'
+    return None
+
+
+def benchmark_intencion(args):
+    app = importar_app(tempfile.mkdtemp(prefix='alma-bench-'), {})
+
+    fallos = [(m, esperado) for m, esperado in CORPUS_INTENCION
+              if app.INDICE_INTENCION.clasificar(m).etapa != esperado]
+    for mensaje, esperado in fallos:
+        print(f"❌ Regresión: {mensaje!r} debería clasificarse como {esperado}")
+    print(f"📋 Corpus de intención: {len(CORPUS_INTENCION) - len(fallos)}/{len(CORPUS_INTENCION)} correctos")
+
+    mensajes = [m for m, _ in CORPUS_INTENCION] + [
+        "Hoy me siento un poco ansioso por el trabajo y no he dormido bien, "
+        "¿me puedes ayudar con una meditación corta para calmarme antes de dormir?"
+    ]
+
+    print(f"\n⏱️  µs por mensaje ({args.iteraciones} iteraciones)")
+    print(f"{'frases':>8} {'lineal':>10} {'indice':>10}")
+    for extra in (0, 100, 1000, 5000):
+        indice = app.IndiceIntencion(triggers=app.TRIGGERS_SUSCRIPCION + frases_sinteticas(extra))
+        lineal = medir(lambda m: clasificar_lineal(indice, m), mensajes, args.iteraciones)
+        compilado = medir(lambda m: indice.clasificar(m), mensajes, args.iteraciones)
+        total = (len(indice.pesos) + len(indice.prioridad_trigger)
+                 + sum(1 + len(c) for _, c in indice.naturales))
+        print(f"{total:>8} {lineal:>10.2f} {compilado:>10.2f}")
+
+    return 1 if fallos else 0
+
+
+# --- MEMORIA POR SESIÓN ACTIVA ---
+
+
+def sesion_dict(indice, turnos):
+    """Representación anterior: dicts con fechas ISO y lista de turnos"""
+    return {
+        'conversation_history': [
+            {'user': f'mensaje {j} del usuario {indice}', 'alma': f'respuesta {j} para {indice}',
+             'timestamp': datetime.now().isoformat(), 'comercial': False}
+            for j in range(turnos)
+        ],
+        'created_at': datetime.now().isoformat(),
+        'session_start_time': datetime.now().timestamp(),
+        'recordatorio_enviado': False,
+        'crisis_count': 0,
+        'last_contact': datetime.now().isoformat(),
+    }
+
+
+def sesion_compacta(app, indice, turnos):
+    session = app.SesionUsuario()
+    for j in range(turnos):
+        session.agregar_turno(f'mensaje {j} del usuario {indice}', f'respuesta {j} para {indice}', False)
+    return session
+
+
+def bytes_por_sesion(crear, cantidad):
+    tracemalloc.start()
+    antes = tracemalloc.get_traced_memory()[0]
+    sesiones = {f'whatsapp:+{i}': crear(i) for i in range(cantidad)}
+    despues = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del sesiones
+    return (despues - antes) / cantidad
+
+
+def benchmark_memoria_sesiones(args):
+    app = importar_app(tempfile.mkdtemp(prefix='alma-bench-'), {})
+
+    print(f"💾 Bytes por sesión activa ({args.turnos} turnos de historial)")
+    print(f"{'sesiones':>10} {'dict':>10} {'compacta':>10}")
+    for cantidad in (10_000, 100_000):
+        anterior = bytes_por_sesion(lambda i: sesion_dict(i, args.turnos), cantidad)
+        compacta = bytes_por_sesion(lambda i: sesion_compacta(app, i, args.turnos), cantidad)
+        print(f"{cantidad:>10} {anterior:>10.0f} {compacta:>10.0f}")
+    return 0
+
+
+# --- PRUEBA DE CARGA DEL WEBHOOK CON DEEPSEEK Y TWILIO LOCALES ---
+
+# Mensajes por tipo de usuario simulado
+MENSAJES_POBLACION = {
+    'trial': "hola, hoy me siento un poco ansioso por el trabajo",
+    'suscriptor': "me ayudas con una respiración para dormir mejor?",
+    'bloqueado': "hola alma, ¿estás ahí?",
+    'crisis': "ya no puedo más, quiero suicidarme",
+    'comercial': "cuánto cuesta la suscripción",
+}
+RESPUESTA_FALSA = ("Hola cariño, gracias por escribirme. 🌿\n\n"
+                   "Respira hondo tres veces, soltando el aire despacio.\n\n"
+                   "Cuéntame, ¿qué es lo que más te inquieta ahora mismo?")
+
+
+def servidor_falso(manejador):
+    """ThreadingHTTPServer en un puerto libre de localhost; devuelve (servidor, url_base)"""
+    servidor = ThreadingHTTPServer(('127.0.0.1', 0), manejador)
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor, f"http://127.0.0.1:{servidor.server_port}"
+
+
+def latencia_simulada(media, jitter):
+    time.sleep(max(0.0, random.uniform(media - jitter, media + jitter)))
+
+
+def crear_deepseek_falso(args):
+    class DeepSeekFalso(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *_):
+            pass
+
+        def responder(self, estado, cuerpo, tipo='application/json'):
+            datos = cuerpo.encode()
+            self.send_response(estado)
+            self.send_header('Content-Type', tipo)
+            self.send_header('Content-Length', str(len(datos)))
+            self.end_headers()
+            self.wfile.write(datos)
+
+        def do_POST(self):
+            peticion = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            latencia_simulada(args.latencia_deepseek, args.jitter)
+            if random.random() < args.error_deepseek:
+                return self.responder(500, '{"error": "simulado"}')
+            if not peticion.get('stream'):
+                return self.responder(200, json.dumps(
+                    {'choices': [{'message': {'role': 'assistant', 'content': RESPUESTA_FALSA}}]}))
+            # SSE por trozos, sin Content-Length (se cierra la conexión al terminar)
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            for i in range(0, len(RESPUESTA_FALSA), 12):
+                delta = {'choices': [{'delta': {'content': RESPUESTA_FALSA[i:i + 12]}}]}
+                self.wfile.write(f"data: {json.dumps(delta)}\n\n".encode())
+                self.wfile.flush()
+                time.sleep(args.latencia_deepseek / 20)
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.close_connection = True
+
+    return DeepSeekFalso
+
+
+def crear_twilio_falso(args, entregas):
+    class TwilioFalso(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *_):
+            pass
+
+        def do_POST(self):
+            cuerpo = self.rfile.read(int(self.headers['Content-Length'])).decode()
+            latencia_simulada(args.latencia_twilio, args.jitter / 10)
+            if random.random() < args.error_twilio:
+                estado, datos = 429, {'code': 20429, 'message': 'Too Many Requests', 'status': 429}
+            else:
+                entregas.append(time.perf_counter())
+                estado, datos = 201, {'sid': f"SM{random.getrandbits(64):016x}", 'status': 'queued',
+                                      'body': cuerpo[:20]}
+            respuesta = json.dumps(datos).encode()
+            self.send_response(estado)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(respuesta)))
+            self.end_headers()
+            self.wfile.write(respuesta)
+
+    return TwilioFalso
+
+
+def cliente_twilio_local(url_base):
+    """Client de Twilio real cuyas peticiones a api.twilio.com se redirigen al servidor falso"""
+    from twilio.http.http_client import TwilioHttpClient
+    from twilio.rest import Client
+
+    class HttpClientLocal(TwilioHttpClient):
+        def request(self, method, url, *posicionales, **nombrados):
+            url = url.replace('https://api.twilio.com', url_base)
+            return super().request(method, url, *posicionales, **nombrados)
+
+    return Client('AC' + '0' * 32, 'token-falso', http_client=HttpClientLocal(pool_connections=True))
+
+
+def preparar_poblacion(app, mezcla, usuarios):
+    """Lista de (telefono, tipo) con el estado persistente que cada tipo necesita"""
+    tipos = []
+    for tipo, peso in mezcla.items():
+        tipos += [tipo] * peso
+    poblacion = []
+    for i in range(usuarios):
+        # Reparto proporcional intercalado (no todos los de un tipo al principio)
+        tipo = tipos[i * len(tipos) // usuarios]
+        phone = f'whatsapp:+52{i:08d}'
+        if tipo == 'suscriptor':
+            app.activar_suscripcion(phone)
+        elif tipo == 'bloqueado':
+            # Trial vencido y sin suscripción
+            inicio = datetime.now() - timedelta(days=app.DIAS_TRIAL_GRATIS + 10)
+            app.almacen.guardar(app.COLECCION_TRIALS, phone, {
+                'trial_start_date': inicio.strftime('%Y-%m-%d'),
+                'trial_end_date': (inicio + timedelta(days=app.DIAS_TRIAL_GRATIS)).strftime('%Y-%m-%d'),
+                'is_subscribed': False,
+                'created_at': inicio.isoformat(),
+            })
+        poblacion.append((phone, tipo))
+    return poblacion
+
+
+def percentil(valores, p):
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(len(ordenados) * p))]
+
+
+def desglose_etapas(texto_metricas):
+    """{etapa: (llamadas, promedio_ms, p99_aprox_ms)} a partir del texto de /metrics"""
+    buckets, sumas, conteos = {}, {}, {}
+    patron = re.compile(r'alma_etapa_segundos_(bucket|sum|count)\{etapa="([^"]+)"(?:,le="([^"]+)")?\} (\S+)')
+    for linea in texto_metricas.splitlines():
+        m = patron.match(linea)
+        if not m:
+            continue
+        serie, etapa, limite, valor = m.groups()
+        if serie == 'bucket' and limite != '+Inf':
+            buckets.setdefault(etapa, []).append((float(limite), float(valor)))
+        elif serie == 'sum':
+            sumas[etapa] = float(valor)
+        elif serie == 'count':
+            conteos[etapa] = int(float(valor))
+    desglose = {}
+    for etapa, total in conteos.items():
+        if not total:
+            continue
+        # Primer bucket que acumula el 99 %: cota superior del p99
+        p99 = next((limite for limite, acumulado in buckets.get(etapa, []) if acumulado >= 0.99 * total),
+                   float('inf'))
+        desglose[etapa] = (total, sumas[etapa] / total * 1000, p99 * 1000)
+    return desglose
+
+
+def prueba_carga(args):
+    import requests
+    from werkzeug.serving import make_server
+
+    random.seed(args.semilla)
+    entregas = []
+    deepseek, url_deepseek = servidor_falso(crear_deepseek_falso(args))
+    twilio, url_twilio = servidor_falso(crear_twilio_falso(args, entregas))
+
+    app = importar_app(tempfile.mkdtemp(prefix='alma-carga-'), {
+        'DEEPSEEK_URL': f"{url_deepseek}/chat/completions",
+        'DEEPSEEK_API_KEY': 'clave-falsa',
+        'DEEPSEEK_STREAMING': '1' if args.streaming else '0',
+        'ALMA_WEBHOOK_ASINCRONO': '1' if args.asincrono else '0',
+        'ALMA_STORAGE_BACKEND': args.backend,
+        'ALMA_STORAGE_MODE': args.modo,
+        'ALMA_SESSION_STORE': args.sesiones,
+        'ALMA_ADMISION_MENSAJES_POR_MINUTO': str(args.admision_por_minuto),
+        'ALMA_DEEPSEEK_CONCURRENCIA_MAXIMA': str(args.concurrencia_deepseek),
+    })
+    app.cliente_twilio = cliente_twilio_local(url_twilio)
+
+    mezcla = {}
+    for parte in args.mezcla.split(','):
+        tipo, peso = parte.split(':')
+        mezcla[tipo] = int(peso)
+    poblacion = preparar_poblacion(app, mezcla, args.usuarios)
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    servidor_app = make_server('127.0.0.1', 0, app.app, threaded=True)
+    threading.Thread(target=servidor_app.serve_forever, daemon=True).start()
+    url_app = f"http://127.0.0.1:{servidor_app.server_port}"
+
+    latencias = {tipo: [] for tipo in mezcla}
+    estados = {}
+    lock = threading.Lock()
+
+    def usuario_virtual(phone, tipo):
+        sesion = requests.Session()
+        for _ in range(args.mensajes):
+            inicio = time.perf_counter()
+            r = sesion.post(f"{url_app}/webhook", data={'From': phone, 'Body': MENSAJES_POBLACION[tipo]})
+            duracion = time.perf_counter() - inicio
+            with lock:
+                latencias[tipo].append(duracion)
+                estados[r.status_code] = estados.get(r.status_code, 0) + 1
+
+    # Los prints de la app por mensaje se descartan durante la medición
+    with open(os.devnull, 'w') as nulo, contextlib.redirect_stdout(nulo):
+        inicio = time.perf_counter()
+        hilos = [threading.Thread(target=usuario_virtual, args=u) for u in poblacion]
+        for h in hilos:
+            h.start()
+        for h in hilos:
+            h.join()
+        duracion_envio = time.perf_counter() - inicio
+        if args.asincrono:
+            # El webhook solo encola: se espera a que el pipeline termine (encolados y en proceso)
+            while requests.get(f"{url_app}/health").json()['trabajo_pendiente']:
+                time.sleep(0.05)
+        duracion = time.perf_counter() - inicio
+    metricas = requests.get(f"{url_app}/metrics").text
+
+    servidor_app.shutdown()
+    deepseek.shutdown()
+    twilio.shutdown()
+
+    total = sum(len(v) for v in latencias.values())
+    todas = [x for v in latencias.values() for x in v]
+    print(f"⚙️  {args.usuarios} usuarios x {args.mensajes} mensajes | backend {args.backend}/{args.modo} | "
+          f"sesiones {args.sesiones} | {'asíncrono' if args.asincrono else 'síncrono'}"
+          f"{' + streaming' if args.streaming else ''}")
+    print(f"🌐 DeepSeek {args.latencia_deepseek * 1000:.0f}ms (error {args.error_deepseek:.0%}) | "
+          f"Twilio {args.latencia_twilio * 1000:.0f}ms (error {args.error_twilio:.0%})")
+    print(f"📨 Respuestas HTTP: {dict(sorted(estados.items()))} | mensajes Twilio entregados: {len(entregas)}")
+    if args.asincrono:
+        print(f"⏱️  Encolado: {total / duracion_envio:.1f} req/s | procesado completo: {total / duracion:.1f} msg/s")
+    else:
+        print(f"⏱️  {total / duracion:.1f} req/s en {duracion:.2f}s")
+    rechazados = dict(re.findall(r'alma_admision_rechazados_total\{motivo="(\w+)"\} (\S+)', metricas))
+    if rechazados:
+        print(f"🚦 Rechazados por admisión: {rechazados}")
+
+    print(f"\n{'población':<12} {'n':>6} {'p50 ms':>10} {'p99 ms':>10}")
+    for tipo, valores in list(latencias.items()) + [('TOTAL', todas)]:
+        print(f"{tipo:<12} {len(valores):>6} {percentil(valores, 0.5) * 1000:>10.1f} "
+              f"{percentil(valores, 0.99) * 1000:>10.1f}")
+
+    print(f"\n{'etapa':<18} {'llamadas':>9} {'prom ms':>10} {'p99 ≤ ms':>10}")
+    for etapa, (llamadas, promedio, p99) in sorted(desglose_etapas(metricas).items(),
+                                                   key=lambda e: -e[1][0] * e[1][1]):
+        print(f"{etapa:<18} {llamadas:>9} {promedio:>10.2f} {p99:>10.0f}")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    sub = parser.add_subparsers(dest='comando', required=True)
+
+    p = sub.add_parser('estres-persistencia',
+                       help='N procesos escribiendo a la vez sobre el mismo almacenamiento')
+    p.add_argument('--procesos', type=int, default=8)
+    p.add_argument('--escrituras', type=int, default=100)
+    p.add_argument('--backend', choices=['json', 'sqlite'], default='json')
+    p.add_argument('--modo', choices=['json', 'journal'], default='json')
+    p.set_defaults(funcion=estres_persistencia)
+
+    p = sub.add_parser('crisis', help='Corpus de regresión y micro-benchmark del detector de crisis')
+    p.add_argument('--iteraciones', type=int, default=20000)
+    p.set_defaults(funcion=benchmark_crisis)
+
+    p = sub.add_parser('intencion', help='Benchmark del índice de intención comercial')
+    p.add_argument('--iteraciones', type=int, default=20000)
+    p.set_defaults(funcion=benchmark_intencion)
+
+    p = sub.add_parser('memoria-sesiones', help='Bytes por sesión activa con 10k y 100k sesiones')
+    p.add_argument('--turnos', type=int, default=3)
+    p.set_defaults(funcion=benchmark_memoria_sesiones)
+
+    p = sub.add_parser('carga', help='Prueba de carga de /webhook con DeepSeek y Twilio locales')
+    p.add_argument('--usuarios', type=int, default=50)
+    p.add_argument('--mensajes', type=int, default=5, help='Mensajes por usuario (en serie)')
+    p.add_argument('--mezcla', default='trial:40,suscriptor:30,bloqueado:10,crisis:5,comercial:15',
+                   help='Pesos por población: ' + ', '.join(MENSAJES_POBLACION))
+    p.add_argument('--latencia-deepseek', type=float, default=0.3)
+    p.add_argument('--latencia-twilio', type=float, default=0.05)
+    p.add_argument('--jitter', type=float, default=0.1)
+    p.add_argument('--error-deepseek', type=float, default=0.0)
+    p.add_argument('--error-twilio', type=float, default=0.0)
+    p.add_argument('--streaming', action='store_true')
+    p.add_argument('--asincrono', action='store_true', help='Webhook que encola (pipeline)')
+    p.add_argument('--backend', choices=['json', 'sqlite'], default='json')
+    p.add_argument('--modo', choices=['json', 'journal'], default='json')
+    p.add_argument('--sesiones', choices=['memoria', 'sqlite'], default='memoria')
+    p.add_argument('--admision-por-minuto', type=float, default=6,
+                   help='Mensajes por minuto por teléfono (0 desactiva la cubeta)')
+    p.add_argument('--concurrencia-deepseek', type=int, default=32,
+                   help='Tope del límite adaptativo de llamadas simultáneas a DeepSeek')
+    p.add_argument('--semilla', type=int, default=7)
+    p.set_defaults(funcion=prueba_carga)
+
+    args = parser.parse_args()
+    sys.exit(args.funcion(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,10 @@
+# Configuración de gunicorn para Alma (gunicorn la carga sola desde el directorio de trabajo)
+
+
+def post_worker_init(worker):
+    """Arranca las tareas en segundo plano ya dentro de cada worker (después del fork).
+
+    Solo el worker que gana el lock de liderazgo ejecuta las tareas compartidas.
+    """
+    from app import iniciar_tareas_fondo
+    iniciar_tareas_fondo()